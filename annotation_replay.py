@@ -0,0 +1,70 @@
+import cv2 as cv
+import marker_detector as mkdtct
+from marker_detector import MarkerDetection
+from result_sink import readCsvResults
+
+
+def replayAnnotations(
+    videoPath: str,
+    outputPath: str,
+    detectionsByFrame: dict[int, list[MarkerDetection]],
+    fps: float = None,
+) -> None:
+    """Produce the annotated video from detections stored by a previous run, so
+    a headless detection can be inspected without running it again.
+
+    Args:
+        videoPath (str): path of the input video.
+        outputPath (str): path of the annotated video to produce.
+        detectionsByFrame (dict[int, list[MarkerDetection]]): detections of each
+        frame, as returned by result_sink.readCsvResults.
+        fps (float, optional): frame rate of the produced video, or None for the
+        frame rate of the input video. Defaults to None.
+    """
+    vidcap = cv.VideoCapture(videoPath)
+    frameSize = (
+        int(vidcap.get(cv.CAP_PROP_FRAME_WIDTH)),
+        int(vidcap.get(cv.CAP_PROP_FRAME_HEIGHT)),
+    )
+    if fps is None:
+        fps = vidcap.get(cv.CAP_PROP_FPS) or 29.97
+    videoWriter = cv.VideoWriter(
+        outputPath, cv.VideoWriter_fourcc("m", "p", "4", "v"), fps, frameSize
+    )
+    try:
+        index = 0
+        while True:
+            success, frame = vidcap.read()
+            if not success:
+                break
+            mkdtct.annotateFrame(frame, detectionsByFrame.get(index, []))
+            videoWriter.write(frame)
+            index += 1
+    finally:
+        vidcap.release()
+        videoWriter.release()
+
+
+def replayCsvAnnotations(videoPath: str, csvPath: str, outputPath: str) -> None:
+    """Produce the annotated video from the csv file written by a previous run.
+
+    Args:
+        videoPath (str): path of the input video.
+        csvPath (str): path of the csv file with the detections.
+        outputPath (str): path of the annotated video to produce.
+    """
+    replayAnnotations(videoPath, outputPath, readCsvResults(csvPath))
+
+
+if __name__ == "__main__":
+    # Selectable videos
+    loadableVideos = {"Toucan": 1, "Dino": 2, "Cracker": 3, "Ganesh": 4}
+
+    # Choose one among the keys in loadableVideos
+    objectToTrack = loadableVideos["Ganesh"]
+
+    replayCsvAnnotations(
+        f"../data/obj0{objectToTrack}.mp4",
+        f"obj{objectToTrack}_marker.csv",
+        f"../data/obj{objectToTrack}_marker.mp4",
+    )
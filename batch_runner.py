@@ -0,0 +1,281 @@
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+from time import perf_counter
+import cv2 as cv
+import main
+from detection_store import DetectionStoreSink
+from result_sink import CsvResultSink
+
+# Extensions of the files picked up when a directory is given as input.
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mov", ".mkv")
+# Suffix of the outputs of the detection, which are never taken as inputs.
+OUTPUT_SUFFIX = "_marker"
+
+
+class _CountingSink:
+    """Result sink forwarding the detections to another sink while counting the
+    processed frames.
+    """
+
+    def __init__(self, sink) -> None:
+        self.sink = sink
+        self.frames = 0
+
+    def write(self, frame: int, detections: list) -> None:
+        self.frames += 1
+        self.sink.write(frame, detections)
+
+    def flush(self) -> None:
+        self.sink.flush()
+
+    def close(self) -> None:
+        self.sink.close()
+
+
+def collectVideos(inputs: list[str]) -> list[str]:
+    """List the videos to process.
+
+    Args:
+        inputs (list[str]): paths of videos, or of directories whose videos are all
+        processed. The annotated videos produced by a previous run are skipped.
+
+    Returns:
+        list[str]: paths of the videos, without duplicates.
+    """
+    videos = []
+    for path in inputs:
+        if os.path.isdir(path):
+            videos.extend(
+                os.path.join(path, name)
+                for name in sorted(os.listdir(path))
+                if name.lower().endswith(VIDEO_EXTENSIONS)
+                and not os.path.splitext(name)[0].endswith(OUTPUT_SUFFIX)
+            )
+        else:
+            videos.append(path)
+    return list(dict.fromkeys(videos))
+
+
+def countFrames(videoPath: str) -> int:
+    """Read the number of frames declared by a video.
+
+    Args:
+        videoPath (str): path of the video.
+
+    Returns:
+        int: number of frames, or -1 if the video can't be opened.
+    """
+    vidcap = cv.VideoCapture(videoPath)
+    try:
+        if not vidcap.isOpened():
+            return -1
+        return int(vidcap.get(cv.CAP_PROP_FRAME_COUNT))
+    finally:
+        vidcap.release()
+
+
+def outputPaths(videoPath: str, outputDir: str) -> tuple[str]:
+    """Paths of the outputs of a video, named as the ones of main.py.
+
+    Args:
+        videoPath (str): path of the input video.
+        outputDir (str): directory of the outputs.
+
+    Returns:
+        tuple[str]: paths of the csv file, of the annotated video, of the
+        profiling report and of the columnar store.
+    """
+    name = os.path.splitext(os.path.basename(videoPath))[0] + OUTPUT_SUFFIX
+    return (
+        os.path.join(outputDir, name + ".csv"),
+        os.path.join(outputDir, name + ".mp4"),
+        os.path.join(outputDir, name + "_profile.json"),
+        os.path.join(outputDir, name + ".npy"),
+    )
+
+
+def _initJob(singleThreaded: bool) -> None:
+    # Several videos are processed at once: letting OpenCV spawn its own threads
+    # in each of them would only oversubscribe the cores.
+    if singleThreaded:
+        cv.setNumThreads(1)
+
+
+def _runJob(videoPath: str, outputDir: str, options: dict) -> dict:
+    """Detect the markers of a video, in a process of the batch pool.
+
+    Args:
+        videoPath (str): path of the input video.
+        outputDir (str): directory of the outputs.
+        options (dict): keyword arguments of main.trackVideo, plus "profile" and
+        "store", to write a detection_store instead of the csv file.
+
+    Returns:
+        dict: number of processed frames and elapsed time, in seconds.
+    """
+    options = dict(options)
+    csvPath, outputVideoPath, profilePath, storePath = outputPaths(videoPath, outputDir)
+    if options.pop("profile", False):
+        options["profilePath"] = profilePath
+    resultSink = (
+        DetectionStoreSink(storePath)
+        if options.pop("store", False)
+        else CsvResultSink(csvPath)
+    )
+    start = perf_counter()
+    with resultSink:
+        sink = _CountingSink(resultSink)
+        main.trackVideo(videoPath, csvPath, outputVideoPath, sink=sink, **options)
+    return {"frames": sink.frames, "elapsed": perf_counter() - start}
+
+
+def runBatch(
+    videos: list[str],
+    outputDir: str,
+    jobs: int = 1,
+    options: dict = None,
+    log=print,
+) -> dict:
+    """Detect the markers of many videos, processing several of them at once.
+
+    The videos are handed to a pool of jobs processes from the longest to the
+    shortest one, according to their declared number of frames, so each process
+    picks up the longest video left as soon as it gets free, and the short videos
+    fill the gaps at the end of the batch. A video which can't be opened or fails
+    during the detection is reported, without stopping the rest of the batch.
+
+    Args:
+        videos (list[str]): paths of the input videos.
+        outputDir (str): directory of the csv files and annotated videos.
+        jobs (int, optional): number of videos processed at once. Defaults to 1.
+        options (dict, optional): keyword arguments of main.trackVideo, plus
+        "profile" to write the stage timings of each video, and "store" to write
+        the detections to a columnar store instead of a csv file. Defaults to None.
+        log (optional): callable receiving the progress messages. Defaults to
+        print.
+
+    Returns:
+        dict: report with the outcome of each video and the aggregate throughput.
+    """
+    options = options or {}
+    os.makedirs(outputDir, exist_ok=True)
+    results = {}
+    framesCounts = {}
+    for videoPath in videos:
+        framesCount = countFrames(videoPath)
+        if framesCount < 0:
+            results[videoPath] = {"error": f"Can't open the video {videoPath}."}
+            log(f"[failed] {videoPath}: can't open the video")
+        else:
+            framesCounts[videoPath] = framesCount
+
+    totalFrames = sum(framesCounts.values())
+    doneFrames = 0
+    start = perf_counter()
+    with ProcessPoolExecutor(
+        jobs,
+        mp_context=get_context("spawn"),
+        initializer=_initJob,
+        initargs=(jobs > 1,),
+    ) as pool:
+        futures = {
+            pool.submit(_runJob, videoPath, outputDir, options): videoPath
+            for videoPath in sorted(framesCounts, key=framesCounts.get, reverse=True)
+        }
+        for future in as_completed(futures):
+            videoPath = futures[future]
+            doneFrames += framesCounts[videoPath]
+            progress = f"[{doneFrames / max(totalFrames, 1):6.1%}]"
+            try:
+                result = future.result()
+            except Exception as error:
+                results[videoPath] = {"error": f"{type(error).__name__}: {error}"}
+                log(f"{progress} {videoPath}: failed, {results[videoPath]['error']}")
+                continue
+            result["framesPerSecond"] = result["frames"] / result["elapsed"]
+            results[videoPath] = result
+            log(
+                f"{progress} {videoPath}: {result['frames']} frames in "
+                f"{result['elapsed']:.1f} s ({result['framesPerSecond']:.1f} fps)"
+            )
+    elapsed = perf_counter() - start
+
+    processedFrames = sum(result.get("frames", 0) for result in results.values())
+    return {
+        "videos": {videoPath: results[videoPath] for videoPath in videos},
+        "failed": sum("error" in result for result in results.values()),
+        "frames": processedFrames,
+        "elapsed": elapsed,
+        "framesPerSecond": processedFrames / elapsed if elapsed else 0.0,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Detect and label the markers of many videos."
+    )
+    parser.add_argument(
+        "inputs", nargs="+", help="videos, or directories containing videos"
+    )
+    parser.add_argument(
+        "-o", "--output-dir", default=".", help="directory of the outputs"
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="number of videos processed at once",
+    )
+    parser.add_argument(
+        "--headless",
+        action="store_true",
+        help="write only the csv files, without the annotated videos",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="write the stage timings of each video next to its csv file",
+    )
+    parser.add_argument(
+        "--store",
+        action="store_true",
+        help="write the detections to a columnar store instead of a csv file",
+    )
+    parser.add_argument(
+        "--keyframe-interval",
+        type=int,
+        default=0,
+        help="detect one frame every this many, interpolating the others",
+    )
+    parser.add_argument("--json", help="write the batch report to this file")
+    args = parser.parse_args()
+
+    videos = collectVideos(args.inputs)
+    if not videos:
+        sys.exit("No videos found.")
+    report = runBatch(
+        videos,
+        args.output_dir,
+        max(1, min(args.jobs, len(videos))),
+        {
+            "headless": args.headless,
+            "profile": args.profile,
+            "store": args.store,
+            "keyframeInterval": args.keyframe_interval,
+        },
+    )
+    print(
+        f"{len(videos) - report['failed']}/{len(videos)} videos, "
+        f"{report['frames']} frames in {report['elapsed']:.1f} s "
+        f"({report['framesPerSecond']:.1f} fps)"
+    )
+    if args.json:
+        with open(args.json, "w") as reportFile:
+            json.dump(report, reportFile, indent=2)
+    if report["failed"]:
+        sys.exit(f"{report['failed']} videos failed.")
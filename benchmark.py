@@ -0,0 +1,431 @@
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from math import cos, sin, radians
+from multiprocessing import get_context
+from time import perf_counter
+import cv2 as cv
+import numpy as np
+import marker_detector as mkdtct
+from result_sink import MemoryResultSink
+from stage_profiler import StageProfiler
+
+# Layout of the synthetic markers, in pixels, in the reference system of the
+# marker: the concave corner A is in the origin and the axis lies on the y axis.
+MARKER_OUTLINE = ((0, 0), (-35, 35), (-35, 190), (35, 190), (35, 35))
+MARKER_AXIS_LENGTH = 190
+# Position of each circle along the axis, as a fraction of its length: these are
+# the positions sampled by the detector, with its perspective corrections.
+CIRCLE_POSITIONS = (33 / 190, 62 / 190, 94 / 190, 125 / 190, 157 / 190)
+CIRCLE_RADIUS = 11
+# Turn-table projected on the image: centre and radii of the ellipse traced by
+# the concave corners of the markers.
+TURNTABLE_CENTRE = (1230, 540)
+TURNTABLE_RADII = (360, 330)
+
+
+def renderTurntableFrame(
+    rotation: float, frameShape: tuple[int] = (1080, 1920), noise: float = 0.0
+) -> tuple:
+    """Render a synthetic frame of the turn-table, with the 24 markers at known
+    poses and with their known circle codes.
+
+    Marker i lies at i * 15 degrees (plus the rotation of the table) and its
+    circles encode i in binary, the first circle from A being the least
+    significant bit. Only the markers falling entirely within the region of
+    interest of the detector are drawn.
+
+    Args:
+        rotation (float): rotation of the turn-table, in degrees.
+        frameShape (tuple[int], optional): (height, width) of the frame. Defaults
+        to (1080, 1920).
+        noise (float, optional): standard deviation of the gaussian noise added to
+        the frame. Defaults to 0.0.
+
+    Returns:
+        tuple: BGR frame, and the list of (marker id, Px, Py) of the drawn markers.
+    """
+    frame = np.full((*frameShape, 3), 60, dtype=np.uint8)
+    roiX0, roiY0, roiX1, roiY1 = mkdtct.clipRoi(mkdtct.MARKERS_ROI, frame.shape)
+    groundTruth = []
+    for markerId in range(24):
+        angle = radians(rotation + markerId * 15)
+        px = TURNTABLE_CENTRE[0] + TURNTABLE_RADII[0] * cos(angle)
+        py = TURNTABLE_CENTRE[1] + TURNTABLE_RADII[1] * sin(angle)
+        # The axis of the marker points outwards, away from the centre.
+        axis = np.array((cos(angle), sin(angle)))
+        across = np.array((-sin(angle), cos(angle)))
+        outline = np.array(
+            [(px, py) + axis * along + across * side for side, along in MARKER_OUTLINE]
+        )
+        if (
+            outline[:, 0].min() < roiX0 + 15
+            or outline[:, 0].max() > roiX1 - 10
+            or outline[:, 1].min() < roiY0 + 10
+            or outline[:, 1].max() > roiY1 - 10
+        ):
+            continue
+        cv.fillPoly(frame, [np.rint(outline).astype(np.int32)], (255, 255, 255))
+        for bit, position in enumerate(CIRCLE_POSITIONS):
+            if markerId >> bit & 1:
+                centre = np.array((px, py)) + axis * MARKER_AXIS_LENGTH * position
+                cv.circle(
+                    frame, tuple(np.rint(centre).astype(int)), CIRCLE_RADIUS, 0, -1
+                )
+        groundTruth.append((markerId, round(px), round(py)))
+    if noise > 0:
+        noisyFrame = frame + np.random.default_rng(round(rotation * 1000)).normal(
+            0, noise, frame.shape
+        )
+        frame = np.clip(noisyFrame, 0, 255).astype(np.uint8)
+    return frame, groundTruth
+
+
+def writeSyntheticVideo(
+    path: str, framesCount: int, degreesPerFrame: float = 0.5, noise: float = 0.0
+) -> list[list[tuple]]:
+    """Write a synthetic turn-table video, encoded as the dataset videos.
+
+    Args:
+        path (str): path of the video to write.
+        framesCount (int): number of frames.
+        degreesPerFrame (float, optional): rotation of the table between two
+        frames. Defaults to 0.5.
+        noise (float, optional): standard deviation of the gaussian noise added to
+        each frame. Defaults to 0.0.
+
+    Returns:
+        list[list[tuple]]: ground truth of each frame, see renderTurntableFrame.
+    """
+    videoWriter = cv.VideoWriter(
+        path, cv.VideoWriter_fourcc("m", "p", "4", "v"), 29.97, (1920, 1080)
+    )
+    groundTruth = []
+    for index in range(framesCount):
+        frame, frameGroundTruth = renderTurntableFrame(
+            index * degreesPerFrame, noise=noise
+        )
+        videoWriter.write(frame)
+        groundTruth.append(frameGroundTruth)
+    videoWriter.release()
+    return groundTruth
+
+
+def percentiles(samples: list[float]) -> dict[str, float]:
+    """Summarize timing samples, in milliseconds.
+
+    Args:
+        samples (list[float]): samples, in seconds.
+
+    Returns:
+        dict[str, float]: mean, p50, p99 and max of the samples, in milliseconds.
+    """
+    if not samples:
+        return {"mean": 0.0, "p50": 0.0, "p99": 0.0, "max": 0.0}
+    milliseconds = np.array(samples) * 1000
+    return {
+        "mean": float(milliseconds.mean()),
+        "p50": float(np.percentile(milliseconds, 50)),
+        "p99": float(np.percentile(milliseconds, 99)),
+        "max": float(milliseconds.max()),
+    }
+
+
+def timeDetectionStages(
+    frames: list[np.ndarray], detector: mkdtct.MarkerDetector = None
+) -> tuple:
+    """Time each stage of the detection over the given frames through a
+    StageProfiler.
+
+    Args:
+        frames (list[np.ndarray]): frames to process. They are not modified.
+        detector (MarkerDetector, optional): detector to time, or None to time
+        detectAndLabelMarkers. Defaults to None.
+
+    Returns:
+        tuple: summary of the profiler, with the timings of each stage, of the
+        whole detection, and the number of contours, polygons and markers, and
+        the detections of each frame.
+    """
+    detect = mkdtct.detectAndLabelMarkers if detector is None else detector.detect
+    profiler = StageProfiler()
+    detectionsByFrame = {}
+    for index, frame in enumerate(frames):
+        stageStart = profiler.now()
+        detectionsByFrame[index] = detect(frame.copy(), index, profiler=profiler)
+        profiler.record("detect", stageStart)
+    return profiler.summary(), detectionsByFrame
+
+
+def comparePyramidSearch(
+    frames: list[np.ndarray],
+    groundTruth: list[list[tuple]],
+    pyramidScale: float,
+    tolerance: int,
+) -> dict:
+    """Compare the coarse-to-fine search of the pentagons with the full-resolution
+    one, timing both and checking both against the ground truth.
+
+    Args:
+        frames (list[np.ndarray]): frames to process. They are not modified.
+        groundTruth (list[list[tuple]]): ground truth of each frame.
+        pyramidScale (float): scale of the coarse search, see MarkerDetector.
+        tolerance (int): maximum position error, in pixels, of a correct
+        detection.
+
+    Returns:
+        dict: stage timings and accuracy of each search.
+    """
+    report = {"pyramidScale": pyramidScale}
+    for name, scale in (("fullResolution", None), ("coarseToFine", pyramidScale)):
+        stages, detectionsByFrame = timeDetectionStages(
+            frames, mkdtct.MarkerDetector(frames[0].shape, pyramidScale=scale)
+        )
+        report[name] = {
+            "stages": stages,
+            "accuracy": checkAccuracy(detectionsByFrame, groundTruth, tolerance),
+        }
+    return report
+
+
+def checkAccuracy(
+    detectionsByFrame: dict[int, list], groundTruth: list[list[tuple]], tolerance: int
+) -> dict[str, float]:
+    """Compare the detections with the ground truth of the synthetic video.
+
+    Args:
+        detectionsByFrame (dict[int, list]): detections of each frame.
+        groundTruth (list[list[tuple]]): ground truth of each frame.
+        tolerance (int): maximum distance, in pixels on each axis, between a
+        detected and a true concave corner.
+
+    Returns:
+        dict[str, float]: recall and precision of the decoded ids, and the mean
+        and max position error of the markers whose id was correctly decoded.
+    """
+    truePositives = falseNegatives = falsePositives = 0
+    errors = []
+    for index, frameGroundTruth in enumerate(groundTruth):
+        expected = {markerId: (px, py) for markerId, px, py in frameGroundTruth}
+        found = {
+            detection.markerId: (detection.px, detection.py)
+            for detection in detectionsByFrame.get(index, [])
+        }
+        for markerId, (px, py) in found.items():
+            if markerId not in expected:
+                falsePositives += 1
+                continue
+            error = max(
+                abs(px - expected[markerId][0]), abs(py - expected[markerId][1])
+            )
+            if error > tolerance:
+                falsePositives += 1
+                continue
+            truePositives += 1
+            errors.append(error)
+        falseNegatives += len(expected) - len(expected.keys() & found.keys())
+    return {
+        "recall": truePositives / max(truePositives + falseNegatives, 1),
+        "precision": truePositives / max(truePositives + falsePositives, 1),
+        "meanPositionError": float(np.mean(errors)) if errors else 0.0,
+        "maxPositionError": float(np.max(errors)) if errors else 0.0,
+    }
+
+
+def _runEndToEnd(workingDir: str, options: dict) -> dict:
+    """Run detectMarkerAndTrack over the synthetic video, in a fresh process so
+    that its peak memory is measured alone.
+
+    Args:
+        workingDir (str): directory containing the "run" folder, where the
+        detection is run, and the "data" folder, with the synthetic video.
+        options (dict): keyword arguments of detectMarkerAndTrack.
+
+    Returns:
+        dict: elapsed time, latency from the decoding of every frame to the
+        writing of its detections, interval between consecutive writes,
+        detections and peak resident memory.
+    """
+    import main
+
+    # Frames are decoded and written in order, so the k-th decoding is frame k.
+    decodeTimes = []
+
+    class _TimedCapture(cv.VideoCapture):
+        def read(self, image=None) -> tuple:
+            success, frame = super().read(image)
+            if success:
+                decodeTimes.append(perf_counter())
+            return success, frame
+
+    class _TimedSink(MemoryResultSink):
+        def __init__(self) -> None:
+            super().__init__()
+            self.completionTimes = {}
+
+        def write(self, frame, detections) -> None:
+            super().write(frame, detections)
+            self.completionTimes[frame] = perf_counter()
+
+    # Both the pipelined and the parallel path decode through the capture
+    # opened by detectMarkerAndTrack.
+    main.VideoCapture = _TimedCapture
+    os.chdir(os.path.join(workingDir, "run"))
+    sink = _TimedSink()
+    start = perf_counter()
+    main.detectMarkerAndTrack(9, sink=sink, **options)
+    elapsed = perf_counter() - start
+    frames = sorted(sink.completionTimes)
+    completionTimes = [sink.completionTimes[frame] for frame in frames]
+    return {
+        "elapsed": elapsed,
+        "frameLatencies": [
+            completionTimes[index] - decodeTimes[frame]
+            for index, frame in enumerate(frames)
+        ],
+        "frameIntervals": np.diff([start] + completionTimes).tolist(),
+        "detections": sink.detections,
+        # ru_maxrss is expressed in kilobytes on Linux.
+        "peakRssMb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def runBenchmark(
+    framesCount: int = 120,
+    degreesPerFrame: float = 0.5,
+    noise: float = 2.0,
+    tolerance: int = 2,
+    options: dict = None,
+    pyramidScale: float = None,
+) -> dict:
+    """Benchmark the detector over a synthetic video, timing each stage of the
+    detection and the end-to-end throughput of detectMarkerAndTrack, and checking
+    the decoded ids and positions against the ground truth.
+
+    Args:
+        framesCount (int, optional): number of frames of the synthetic video.
+        Defaults to 120.
+        degreesPerFrame (float, optional): rotation of the table between two
+        frames. Defaults to 0.5.
+        noise (float, optional): standard deviation of the gaussian noise added to
+        each frame. Defaults to 2.0.
+        tolerance (int, optional): maximum position error, in pixels, of a correct
+        detection. Defaults to 2.
+        options (dict, optional): keyword arguments of detectMarkerAndTrack.
+        Defaults to None.
+        pyramidScale (float, optional): if given, the coarse-to-fine search of the
+        pentagons at this scale is compared with the full-resolution one, see
+        comparePyramidSearch. Defaults to None.
+
+    Returns:
+        dict: benchmark report.
+    """
+    options = options or {}
+    with tempfile.TemporaryDirectory() as workingDir:
+        os.mkdir(os.path.join(workingDir, "data"))
+        os.mkdir(os.path.join(workingDir, "run"))
+        videoPath = os.path.join(workingDir, "data", "obj09.mp4")
+        groundTruth = writeSyntheticVideo(
+            videoPath, framesCount, degreesPerFrame, noise
+        )
+
+        # Stage timings over the decoded frames, which carry the compression
+        # artifacts of the real videos.
+        vidcap = cv.VideoCapture(videoPath)
+        frames = []
+        while len(frames) < min(framesCount, 60):
+            success, frame = vidcap.read()
+            if not success:
+                break
+            frames.append(frame)
+        vidcap.release()
+        stages, _ = timeDetectionStages(frames)
+        pyramid = None
+        if pyramidScale is not None:
+            pyramid = comparePyramidSearch(
+                frames, groundTruth[: len(frames)], pyramidScale, tolerance
+            )
+        del frames
+
+        # The working directory of the child process is changed, so the
+        # modules of the repository are found through the path.
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        # The workers of a ProcessPoolExecutor are not daemonic, so the run can
+        # start its own pool of detection workers.
+        with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as executor:
+            endToEnd = executor.submit(_runEndToEnd, workingDir, options).result()
+
+    detectionsByFrame = {}
+    for detection in endToEnd["detections"]:
+        detectionsByFrame.setdefault(detection.frame, []).append(detection)
+    report = {
+        "frames": framesCount,
+        "options": options,
+        "stages": stages,
+        "endToEnd": {
+            "framesPerSecond": framesCount / endToEnd["elapsed"],
+            "frameLatency": percentiles(endToEnd["frameLatencies"]),
+            "frameInterval": percentiles(endToEnd["frameIntervals"]),
+            "peakRssMb": endToEnd["peakRssMb"],
+        },
+        "accuracy": checkAccuracy(detectionsByFrame, groundTruth, tolerance),
+    }
+    if pyramid is not None:
+        report["pyramid"] = pyramid
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the marker detector over a synthetic turn-table video."
+    )
+    parser.add_argument("--frames", type=int, default=120)
+    parser.add_argument("--degrees-per-frame", type=float, default=0.5)
+    parser.add_argument("--noise", type=float, default=2.0)
+    parser.add_argument("--tolerance", type=int, default=2)
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--headless", action="store_true")
+    parser.add_argument(
+        "--pyramid-scale",
+        type=float,
+        help="compare the coarse-to-fine search at this scale with the full "
+        "resolution one",
+    )
+    parser.add_argument(
+        "--min-recall",
+        type=float,
+        default=0.98,
+        help="fail if the recall of the decoded ids is lower than this",
+    )
+    parser.add_argument(
+        "--min-precision",
+        type=float,
+        default=0.99,
+        help="fail if the precision of the decoded ids is lower than this",
+    )
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args()
+
+    report = runBenchmark(
+        args.frames,
+        args.degrees_per_frame,
+        args.noise,
+        args.tolerance,
+        {"workers": args.workers, "headless": args.headless},
+        args.pyramid_scale,
+    )
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, "w") as reportFile:
+            json.dump(report, reportFile, indent=2)
+
+    accuracy = report["accuracy"]
+    if (
+        accuracy["recall"] < args.min_recall
+        or accuracy["precision"] < args.min_precision
+    ):
+        sys.exit("Accuracy regression: see the report above.")
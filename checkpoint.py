@@ -0,0 +1,285 @@
+import hashlib
+import json
+import os
+import shutil
+from marker_detector import MarkerDetection
+from result_sink import CsvResultSink, readCsvResults
+
+# Version of the detection results: it is part of the cache keys, and must be
+# increased whenever a change to the detection alters its results, so that the
+# results cached by the previous versions are never returned.
+RESULTS_VERSION = 1
+
+
+def _publicParameters(detector) -> dict:
+    # Type and public attributes of a stateful detector, which its results depend
+    # on.
+    parameters = {
+        name: value
+        for name, value in vars(detector).items()
+        if not name.startswith("_")
+        and isinstance(value, (bool, int, float, str, tuple, list, dict))
+    }
+    parameters["type"] = type(detector).__name__
+    return parameters
+
+
+def runParameters(roi: tuple[int], tracker=None, sampler=None) -> dict:
+    """Parameters which the detections of a video depend on.
+
+    Args:
+        roi (tuple[int]): region (x0, y0, x1, y1) where the markers are searched,
+        or None for the whole frame.
+        tracker (optional): stateful detector used in place of
+        detectAndLabelMarkers. Its type and its public attributes are included.
+        Defaults to None.
+        sampler (optional): keyframe_sampler.KeyframeSampler interpolating the
+        detections between keyframes. Its type and its public attributes are
+        included, only if it is given. Defaults to None.
+
+    Returns:
+        dict: parameters, serializable as json.
+    """
+    parameters = {
+        "version": RESULTS_VERSION,
+        "roi": roi,
+        "tracker": None if tracker is None else _publicParameters(tracker),
+    }
+    # The runs without sampling keep the parameters, and so the cache keys and
+    # the checkpoints, they had before the sampling existed.
+    if sampler is not None:
+        parameters["sampler"] = _publicParameters(sampler)
+    # The round trip through json turns the tuples into lists, so the parameters
+    # compare equal to the ones read back from a checkpoint.
+    return json.loads(json.dumps(parameters))
+
+
+def videoIdentity(videoPath: str) -> dict:
+    """Cheap identity of a video file, which changes whenever the file does.
+
+    Args:
+        videoPath (str): path of the video.
+
+    Returns:
+        dict: absolute path, size and modification time of the file.
+    """
+    stat = os.stat(videoPath)
+    return {
+        "path": os.path.abspath(videoPath),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+    }
+
+
+def hashVideo(videoPath: str, blockSize: int = 1 << 20) -> str:
+    """Hash of the content of a video file, read as raw bytes.
+
+    Args:
+        videoPath (str): path of the video.
+        blockSize (int, optional): number of bytes read at once. Defaults to 1 MiB.
+
+    Returns:
+        str: hexadecimal sha256 of the file.
+    """
+    digest = hashlib.sha256()
+    with open(videoPath, "rb") as videoFile:
+        while block := videoFile.read(blockSize):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def checkpointPath(csvPath: str) -> str:
+    """Path of the checkpoint of a run writing the given csv file."""
+    return csvPath + ".checkpoint"
+
+
+def readCheckpoint(csvPath: str, run: dict) -> dict:
+    """Read the checkpoint left by an interrupted run, if it can be resumed.
+
+    Args:
+        csvPath (str): path of the csv file written by the run.
+        run (dict): identity of the video and parameters of the current run.
+
+    Returns:
+        dict: index of the next frame to process and length, in bytes, of the
+        committed part of the csv file, or None if there is no checkpoint, or if
+        it belongs to a different video or different parameters.
+    """
+    try:
+        with open(checkpointPath(csvPath)) as checkpointFile:
+            checkpoint = json.load(checkpointFile)
+    except (OSError, ValueError):
+        return None
+    if (
+        checkpoint.get("run") != run
+        or not os.path.exists(csvPath)
+        or os.path.getsize(csvPath) < checkpoint["csvBytes"]
+    ):
+        return None
+    return checkpoint
+
+
+class CheckpointedCsvSink(CsvResultSink):
+    """Csv result sink recording a checkpoint every time it flushes its rows.
+
+    The checkpoint holds the index of the next frame to process and the length of
+    the csv file at that point, and is replaced atomically, so after a crash or a
+    pre-emption the file can be cut back to the last checkpoint and the run
+    resumed from the following frame.
+    """
+
+    def __init__(
+        self, path: str, run: dict, flushInterval: int = 100, checkpoint: dict = None
+    ) -> None:
+        """Open the csv file, resuming it from the given checkpoint if any.
+
+        Args:
+            path (str): path of the csv file.
+            run (dict): identity of the video and parameters of the run, stored in
+            the checkpoint.
+            flushInterval (int, optional): number of frames between two
+            checkpoints. Defaults to 100.
+            checkpoint (dict, optional): checkpoint returned by readCheckpoint, or
+            None to start from the first frame. Defaults to None.
+        """
+        super().__init__(
+            path, flushInterval, None if checkpoint is None else checkpoint["csvBytes"]
+        )
+        self.run = run
+        self.nextFrame = 0 if checkpoint is None else checkpoint["nextFrame"]
+
+    def write(self, frame: int, detections: list[MarkerDetection]) -> None:
+        """Buffer the detections of a frame, flushing them and recording a
+        checkpoint if the interval elapsed.
+
+        Args:
+            frame (int): index of the frame.
+            detections (list[MarkerDetection]): markers detected in the frame.
+        """
+        self.nextFrame = frame + 1
+        super().write(frame, detections)
+
+    def flush(self) -> None:
+        """Write the buffered rows to the file, then record the checkpoint."""
+        super().flush()
+        temporaryPath = checkpointPath(self.path) + ".tmp"
+        with open(temporaryPath, "w") as checkpointFile:
+            json.dump(
+                {
+                    "run": self.run,
+                    "nextFrame": self.nextFrame,
+                    "csvBytes": self._file.tell(),
+                },
+                checkpointFile,
+            )
+        os.replace(temporaryPath, checkpointPath(self.path))
+
+    def complete(self) -> None:
+        """Close the file and remove the checkpoint, once the run is over."""
+        self.close()
+        if os.path.exists(checkpointPath(self.path)):
+            os.remove(checkpointPath(self.path))
+
+
+class ResultCache:
+    """Directory of the results of previous runs.
+
+    Every entry is keyed on the content of the input video and on the
+    parameters of the detection, and holds the csv file, the number of frames
+    and, if it was produced, the annotated video. Running an unchanged video
+    with unchanged parameters then only copies the stored results.
+    """
+
+    def __init__(self, cacheDir: str) -> None:
+        """Use the given directory, creating it if needed.
+
+        Args:
+            cacheDir (str): directory of the cache.
+        """
+        self.cacheDir = cacheDir
+        os.makedirs(cacheDir, exist_ok=True)
+
+    @staticmethod
+    def key(videoPath: str, parameters: dict) -> str:
+        """Key of the results of a video.
+
+        Args:
+            videoPath (str): path of the video.
+            parameters (dict): parameters of the detection, see runParameters.
+
+        Returns:
+            str: hexadecimal key.
+        """
+        digest = hashlib.sha256(hashVideo(videoPath).encode())
+        digest.update(json.dumps(parameters, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def load(
+        self,
+        key: str,
+        csvPath: str = None,
+        sink=None,
+        outputVideoPath: str = None,
+    ) -> bool:
+        """Restore the cached results, if any.
+
+        Args:
+            key (str): key of the results.
+            csvPath (str, optional): path where the csv file is copied. Defaults to
+            None.
+            sink (optional): result sink receiving the cached detections of every
+            frame, if csvPath is None. Defaults to None.
+            outputVideoPath (str, optional): path where the annotated video is
+            copied, or None if it isn't needed. Defaults to None.
+
+        Returns:
+            bool: False if the results, or the requested annotated video, are not
+            cached.
+        """
+        entryDir = os.path.join(self.cacheDir, key)
+        cachedVideoPath = os.path.join(entryDir, "annotated.mp4")
+        if not os.path.isdir(entryDir) or (
+            outputVideoPath is not None and not os.path.exists(cachedVideoPath)
+        ):
+            return False
+        cachedCsvPath = os.path.join(entryDir, "detections.csv")
+        if csvPath is not None:
+            shutil.copyfile(cachedCsvPath, csvPath)
+        else:
+            with open(os.path.join(entryDir, "meta.json")) as metaFile:
+                framesCount = json.load(metaFile)["framesCount"]
+            detectionsByFrame = readCsvResults(cachedCsvPath)
+            for frame in range(framesCount):
+                sink.write(frame, detectionsByFrame.get(frame, []))
+        if outputVideoPath is not None:
+            shutil.copyfile(cachedVideoPath, outputVideoPath)
+        return True
+
+    def store(
+        self, key: str, csvPath: str, framesCount: int, outputVideoPath: str = None
+    ) -> None:
+        """Store the results of a run, replacing any previous entry with the same
+        key.
+
+        Args:
+            key (str): key of the results.
+            csvPath (str): path of the csv file produced by the run.
+            framesCount (int): number of frames of the video.
+            outputVideoPath (str, optional): path of the annotated video produced
+            by the run, if any. Defaults to None.
+        """
+        entryDir = os.path.join(self.cacheDir, key)
+        # The entry is prepared aside and renamed at once, so a reader never sees
+        # it half written.
+        temporaryDir = entryDir + ".tmp"
+        shutil.rmtree(temporaryDir, ignore_errors=True)
+        os.mkdir(temporaryDir)
+        shutil.copyfile(csvPath, os.path.join(temporaryDir, "detections.csv"))
+        if outputVideoPath is not None:
+            shutil.copyfile(
+                outputVideoPath, os.path.join(temporaryDir, "annotated.mp4")
+            )
+        with open(os.path.join(temporaryDir, "meta.json"), "w") as metaFile:
+            json.dump({"framesCount": framesCount}, metaFile)
+        shutil.rmtree(entryDir, ignore_errors=True)
+        os.replace(temporaryDir, entryDir)
@@ -0,0 +1,258 @@
+import argparse
+import os
+import numpy as np
+from numpy.lib import format as npyFormat
+from marker_detector import MarkerDetection
+from result_sink import parseCsvRow
+
+# Layout of a record of the store, with an explicit byte order so the files can
+# be shared across machines.
+DETECTION_DTYPE = np.dtype(
+    [
+        ("frame", "<i4"),
+        ("markerId", "<i2"),
+        ("px", "<i4"),
+        ("py", "<i4"),
+        ("x", "<f8"),
+        ("y", "<f8"),
+        ("z", "<f8"),
+    ]
+)
+
+
+def indexPath(path: str) -> str:
+    """Path of the frame index of a store.
+
+    Args:
+        path (str): path of the records of the store.
+
+    Returns:
+        str: path of the index, next to the records.
+    """
+    return os.path.splitext(path)[0] + "_index.npy"
+
+
+def _writeRecordsHeader(storeFile, recordsCount: int) -> None:
+    # numpy pads the header so the length of the array can grow without changing
+    # its size, which lets the header be written again once the length is known.
+    npyFormat.write_array_header_1_0(
+        storeFile,
+        {
+            "descr": npyFormat.dtype_to_descr(DETECTION_DTYPE),
+            "fortran_order": False,
+            "shape": (recordsCount,),
+        },
+    )
+
+
+class DetectionStoreSink:
+    """Result sink writing the detections to a columnar store.
+
+    The store is made of two .npy files: the records, a structured array of
+    DETECTION_DTYPE in frame order, and the index, whose entries i and i + 1 are
+    the first and past-the-end records of frame i. Both can be memory-mapped, so
+    the detections of any frame are found without parsing or scanning the file:
+    see DetectionStore.
+
+    The records are buffered and appended to the file every flushInterval frames,
+    while the index, 8 bytes per frame, is kept in memory and written on close.
+    """
+
+    def __init__(self, path: str, flushInterval: int = 100) -> None:
+        """Create the store, truncating it if it exists.
+
+        Args:
+            path (str): path of the records, usually ending in ".npy". The index is
+            written next to it, see indexPath.
+            flushInterval (int, optional): number of frames buffered before the
+            records are written to the file. Defaults to 100.
+        """
+        self.path = path
+        self.flushInterval = flushInterval
+        self._file = open(path, "wb")
+        _writeRecordsHeader(self._file, 0)
+        self._headerSize = self._file.tell()
+        self._rows = []
+        self._bufferedFrames = 0
+        self._recordsCount = 0
+        self._offsets = [0]
+
+    @property
+    def framesCount(self) -> int:
+        """Number of frames written so far."""
+        return len(self._offsets) - 1
+
+    def write(self, frame: int, detections: list[MarkerDetection]) -> None:
+        """Buffer the detections of a frame, flushing them if the interval elapsed.
+
+        Args:
+            frame (int): index of the frame. The frames must be written in order:
+            the skipped ones are stored as frames without detections.
+            detections (list[MarkerDetection]): markers detected in the frame.
+
+        Raises:
+            ValueError: if the frame was already written.
+        """
+        if frame < self.framesCount:
+            raise ValueError(
+                f"Frame {frame} written after frame {self.framesCount - 1}."
+            )
+        # Any skipped frame gets an empty range of records.
+        self._offsets.extend([self._recordsCount] * (frame - self.framesCount))
+        self._rows.extend(detections)
+        self._recordsCount += len(detections)
+        self._offsets.append(self._recordsCount)
+        self._bufferedFrames += 1
+        if self._bufferedFrames >= self.flushInterval:
+            self.flush()
+
+    def flush(self) -> None:
+        """Append the buffered records to the file."""
+        self._file.write(np.array(self._rows, dtype=DETECTION_DTYPE).tobytes())
+        self._file.flush()
+        self._rows.clear()
+        self._bufferedFrames = 0
+
+    def close(self) -> None:
+        """Flush the buffered records, complete the header with their number, and
+        write the index.
+        """
+        if self._file.closed:
+            return
+        self.flush()
+        self._file.seek(0)
+        _writeRecordsHeader(self._file, self._recordsCount)
+        if self._file.tell() != self._headerSize:
+            raise OSError(f"The header of {self.path} can't be completed in place.")
+        self._file.close()
+        np.save(indexPath(self.path), np.array(self._offsets, dtype="<i8"))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class DetectionStore:
+    """Read access to a store written by DetectionStoreSink.
+
+    Both the records and the index are memory-mapped, so opening a store doesn't
+    read it, and the detections of any frame are a slice of the records, found
+    in constant time through the index. Frames beyond the end of the store have
+    no detections.
+
+    Through get(frame, default), a store can be used in place of the dict of
+    detections of each frame, as in annotation_replay.replayAnnotations.
+    """
+
+    def __init__(self, path: str) -> None:
+        """Memory-map the store.
+
+        Args:
+            path (str): path of the records of the store.
+        """
+        self.path = path
+        self.records = np.load(path, mmap_mode="r")
+        self.index = np.load(indexPath(path), mmap_mode="r")
+
+    def __len__(self) -> int:
+        """Number of frames of the store."""
+        return len(self.index) - 1
+
+    def frameRecords(self, frame: int) -> np.ndarray:
+        """Records of a frame.
+
+        Args:
+            frame (int): index of the frame.
+
+        Returns:
+            np.ndarray: structured array of DETECTION_DTYPE, a view over the file.
+        """
+        if not 0 <= frame < len(self):
+            return self.records[:0]
+        return self.records[self.index[frame] : self.index[frame + 1]]
+
+    def detections(self, frame: int) -> list[MarkerDetection]:
+        """Detections of a frame.
+
+        Args:
+            frame (int): index of the frame.
+
+        Returns:
+            list[MarkerDetection]: markers detected in the frame.
+        """
+        return [
+            MarkerDetection(
+                int(record["frame"]),
+                int(record["markerId"]),
+                int(record["px"]),
+                int(record["py"]),
+                float(record["x"]),
+                float(record["y"]),
+                float(record["z"]),
+            )
+            for record in self.frameRecords(frame)
+        ]
+
+    def get(self, frame: int, default=None) -> list[MarkerDetection]:
+        """Detections of a frame, or default if the frame has none.
+
+        Args:
+            frame (int): index of the frame.
+            default (optional): value returned for frames without detections.
+            Defaults to None.
+
+        Returns:
+            list[MarkerDetection]: markers detected in the frame.
+        """
+        return self.detections(frame) or default
+
+
+def convertCsvToStore(
+    csvPath: str, storePath: str, framesCount: int = None
+) -> DetectionStore:
+    """Convert the csv file written by a previous run into a store.
+
+    Args:
+        csvPath (str): path of the csv file.
+        storePath (str): path of the records of the store to write.
+        framesCount (int, optional): number of frames of the video. The csv file
+        has no rows for the frames without detections, so those after the last
+        detection are stored only if the number of frames is given. Defaults to
+        None.
+
+    Returns:
+        DetectionStore: the converted store.
+    """
+    with open(csvPath) as csvFile, DetectionStoreSink(storePath) as sink:
+        next(csvFile)
+        frame = None
+        frameDetections = []
+        for row in csvFile:
+            if not row.strip():
+                continue
+            detection = parseCsvRow(row)
+            if detection.frame != frame and frame is not None:
+                sink.write(frame, frameDetections)
+                frameDetections = []
+            frame = detection.frame
+            frameDetections.append(detection)
+        if frame is not None:
+            sink.write(frame, frameDetections)
+        if framesCount is not None and framesCount > sink.framesCount:
+            sink.write(framesCount - 1, [])
+    return DetectionStore(storePath)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert csv files of detections into columnar stores."
+    )
+    parser.add_argument("csvPaths", nargs="+", help="csv files to convert")
+    args = parser.parse_args()
+
+    for csvPath in args.csvPaths:
+        storePath = os.path.splitext(csvPath)[0] + ".npy"
+        store = convertCsvToStore(csvPath, storePath)
+        print(f"{csvPath} -> {storePath}: {len(store.records)} detections")
@@ -0,0 +1,82 @@
+from queue import Queue, Empty
+import cv2 as cv
+import numpy as np
+
+
+def readInto(vidcap: cv.VideoCapture, buffer: np.ndarray) -> bool:
+    """Decode the next frame of the video into the given buffer.
+
+    Args:
+        vidcap (cv.VideoCapture): opened input video.
+        buffer (np.ndarray): destination buffer.
+
+    Returns:
+        bool: False if no frame could be read.
+    """
+    success, frame = vidcap.read(buffer)
+    # OpenCV decodes in place only if the buffer fits the frame.
+    if success and frame.ctypes.data != buffer.ctypes.data:
+        buffer[...] = frame
+    return success
+
+
+def captureFrameShape(vidcap: cv.VideoCapture) -> tuple[int]:
+    """Shape of the frames decoded from the video.
+
+    Args:
+        vidcap (cv.VideoCapture): opened input video.
+
+    Returns:
+        tuple[int]: (height, width, 3) shape of each frame.
+    """
+    return (
+        int(vidcap.get(cv.CAP_PROP_FRAME_HEIGHT)),
+        int(vidcap.get(cv.CAP_PROP_FRAME_WIDTH)),
+        3,
+    )
+
+
+class FrameBufferPool:
+    """Fixed ring of preallocated frame buffers.
+
+    The frames are decoded in place into the free buffers, so a long video is
+    processed without allocating a new array for every frame. A buffer is taken
+    with acquire() before decoding into it, and given back with release() once
+    every stage is done with its frame: when no buffer is free, the decoder
+    waits, so the pool also bounds the number of frames in flight.
+    """
+
+    def __init__(self, buffersCount: int, frameShape: tuple[int]) -> None:
+        """Allocate the buffers, all of them free.
+
+        Args:
+            buffersCount (int): number of buffers.
+            frameShape (tuple[int]): shape of each frame.
+        """
+        self.buffers = np.empty((buffersCount, *frameShape), dtype=np.uint8)
+        self._free = Queue()
+        for slot in range(buffersCount):
+            self._free.put(slot)
+
+    def acquire(self, timeout: float = None) -> int:
+        """Take a free buffer, waiting for one to be released if needed.
+
+        Args:
+            timeout (float, optional): maximum wait, in seconds, or None to wait
+            indefinitely. Defaults to None.
+
+        Returns:
+            int: slot of the buffer, or None if none got free within the timeout.
+        """
+        try:
+            return self._free.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def release(self, slot: int) -> None:
+        """Give a buffer back to the pool.
+
+        Args:
+            slot (int): slot of the buffer, as returned by acquire().
+        """
+        self._free.put(slot)
@@ -0,0 +1,252 @@
+import numpy as np
+import marker_detector as mkdtct
+from marker_detector import MarkerDetection
+from stage_profiler import NULL_PROFILER
+
+
+def interpolateDetections(
+    start: tuple, end: tuple, frame: int
+) -> list[MarkerDetection]:
+    """Interpolate linearly the concave corner of every marker between two
+    frames where it was detected.
+
+    Args:
+        start (tuple): index of the first frame and its detections.
+        end (tuple): index of the last frame and its detections, with the same
+        markers as the first one.
+        frame (int): index of the frame to interpolate, between the two.
+
+    Returns:
+        list[MarkerDetection]: markers of the frame, in the order of the first
+        frame, with their corners rounded to the nearest pixel.
+    """
+    startFrame, startDetections = start
+    endFrame, endDetections = end
+    weight = (frame - startFrame) / (endFrame - startFrame)
+    endCorners = {
+        detection.markerId: (detection.px, detection.py) for detection in endDetections
+    }
+    return [
+        detection._replace(
+            frame=frame,
+            px=round(
+                detection.px
+                + (endCorners[detection.markerId][0] - detection.px) * weight
+            ),
+            py=round(
+                detection.py
+                + (endCorners[detection.markerId][1] - detection.py) * weight
+            ),
+        )
+        for detection in startDetections
+    ]
+
+
+def _sameMarkers(
+    detections: list[MarkerDetection], otherDetections: list[MarkerDetection]
+) -> bool:
+    # A label found twice in a frame can't be followed, so it never matches.
+    markerIds = [detection.markerId for detection in detections]
+    return len(set(markerIds)) == len(markerIds) and sorted(markerIds) == sorted(
+        detection.markerId for detection in otherDetections
+    )
+
+
+def interpolationResidual(
+    interpolated: list[MarkerDetection], detected: list[MarkerDetection]
+) -> float:
+    """Largest distance between the interpolated and the detected corner of the
+    same marker.
+
+    Args:
+        interpolated (list[MarkerDetection]): interpolated markers of a frame.
+        detected (list[MarkerDetection]): markers detected in the same frame.
+
+    Returns:
+        float: distance in pixels, infinite if the markers differ.
+    """
+    if not _sameMarkers(detected, interpolated):
+        return float("inf")
+    corners = {
+        detection.markerId: (detection.px, detection.py) for detection in detected
+    }
+    return max(
+        (
+            float(
+                np.hypot(
+                    detection.px - corners[detection.markerId][0],
+                    detection.py - corners[detection.markerId][1],
+                )
+            )
+            for detection in interpolated
+        ),
+        default=0.0,
+    )
+
+
+class KeyframeSampler:
+    """Detection of the markers on sampled frames only, interpolating their
+    positions on the frames in between.
+
+    The frames are pushed in order, and held until the next keyframe, interval
+    frames later, has been detected. If the two keyframes hold the same markers,
+    the frame halfway between them is detected too, and compared with the
+    interpolation: if no corner is further than maxResidual pixels from its
+    interpolated position, the corners of the other frames are interpolated
+    linearly, marker by marker. Whenever a marker appears or disappears, or the
+    residual is exceeded, each half of the interval is handled in the same way,
+    through its own halfway frame: the detection goes back to full rate around
+    the frames where the markers change, and only there. On a smooth motion only
+    two frames out of interval are detected.
+
+    Since the real-world coordinates of a marker only depend on its label, the
+    interpolated detections are complete, and the results stay dense.
+    """
+
+    def __init__(
+        self,
+        interval: int = 8,
+        maxResidual: float = 2.0,
+        roi: tuple[int] = mkdtct.MARKERS_ROI,
+    ) -> None:
+        """Set the sampling parameters.
+
+        Args:
+            interval (int, optional): number of frames between two keyframes.
+            Defaults to 8.
+            maxResidual (float, optional): maximum distance, in pixels, between the
+            detected and the interpolated corner of a marker on the frame halfway
+            between two keyframes. Defaults to 2.0.
+            roi (tuple[int], optional): region (x0, y0, x1, y1) where the markers are
+            searched, or None for the whole frame. Defaults to MARKERS_ROI.
+
+        Raises:
+            ValueError: if the interval is shorter than 2 frames.
+        """
+        if interval < 2:
+            raise ValueError(
+                f"The keyframe interval must be at least 2, not {interval}."
+            )
+        self.interval = interval
+        self.maxResidual = maxResidual
+        self.roi = roi
+        # Last detected frame, already handed out, and the frames following it.
+        self._anchor = None
+        self._pending = []
+
+    def _detect(self, frame: tuple, annotate: bool, profiler) -> tuple:
+        index, image = frame
+        stageStart = profiler.now()
+        detections = mkdtct.detectAndLabelMarkers(
+            image, index, self.roi, annotate, profiler
+        )
+        profiler.record("detect", stageStart)
+        return index, image, detections
+
+    def push(
+        self,
+        index: int,
+        image: np.ndarray,
+        annotate: bool = True,
+        profiler=NULL_PROFILER,
+    ) -> list[tuple]:
+        """Add the next frame, detecting the markers of the held frames once a
+        keyframe is reached.
+
+        Args:
+            index (int): index of the frame, following the previous one.
+            image (np.ndarray): the frame, which must not be modified until it is
+            handed out.
+            annotate (bool, optional): whether to draw the markers on the frames.
+            The interpolated markers are drawn without their polygons. Defaults to
+            True.
+            profiler (optional): stage_profiler.StageProfiler recording the time
+            spent in each stage. Defaults to NULL_PROFILER, which records nothing.
+
+        Returns:
+            list[tuple]: (index, image, detections) of the frames whose markers are
+            known, in order.
+        """
+        if self._anchor is None:
+            self._anchor = self._detect((index, image), annotate, profiler)
+            return [self._anchor]
+        self._pending.append((index, image))
+        if len(self._pending) < self.interval:
+            return []
+        return self._resolve(annotate, profiler)
+
+    def flush(self, annotate: bool = True, profiler=NULL_PROFILER) -> list[tuple]:
+        """Detect or interpolate the markers of the frames still held, the last
+        one becoming a keyframe, at the end of the video.
+
+        Args:
+            annotate (bool, optional): whether to draw the markers on the frames.
+            Defaults to True.
+            profiler (optional): stage_profiler.StageProfiler recording the time
+            spent in each stage. Defaults to NULL_PROFILER, which records nothing.
+
+        Returns:
+            list[tuple]: (index, image, detections) of the remaining frames, in
+            order.
+        """
+        resolved = self._resolve(annotate, profiler) if self._pending else []
+        self._anchor = None
+        return resolved
+
+    def _resolve(self, annotate: bool, profiler) -> list[tuple]:
+        # The frames between the anchor and the new keyframe are detected or
+        # interpolated, then the keyframe becomes the next anchor.
+        keyframe = self._detect(self._pending[-1], annotate, profiler)
+        resolved = self._resolveBetween(
+            self._anchor, self._pending[:-1], keyframe, annotate, profiler
+        )
+        profiler.count(
+            "detectedFrames", 1 + sum(not interpolated for *_, interpolated in resolved)
+        )
+        self._pending = []
+        self._anchor = keyframe
+        return [frame for *frame, _ in resolved] + [keyframe]
+
+    def _resolveBetween(
+        self, start: tuple, between: list[tuple], end: tuple, annotate: bool, profiler
+    ) -> list[tuple]:
+        """Detect the frame halfway between two detected frames, then interpolate
+        the others if the halfway frame matches the interpolation, or else handle
+        each half in the same way.
+
+        Returns:
+            list[tuple]: (index, image, detections, interpolated) of the frames in
+            between, in order.
+        """
+        if not between:
+            return []
+        first = start[0], start[2]
+        last = end[0], end[2]
+        middle = len(between) // 2
+        check = self._detect(between[middle], annotate, profiler)
+        stageStart = profiler.now()
+        if (
+            _sameMarkers(first[1], last[1])
+            and interpolationResidual(
+                interpolateDetections(first, last, check[0]), check[2]
+            )
+            <= self.maxResidual
+        ):
+            resolved = []
+            for position, (index, image) in enumerate(between):
+                if position == middle:
+                    resolved.append((*check, False))
+                    continue
+                detections = interpolateDetections(first, last, index)
+                if annotate:
+                    mkdtct.annotateFrame(image, detections)
+                resolved.append((index, image, detections, True))
+            profiler.record("interpolation", stageStart)
+            return resolved
+        return (
+            self._resolveBetween(start, between[:middle], check, annotate, profiler)
+            + [(*check, False)]
+            + self._resolveBetween(
+                check, between[middle + 1 :], end, annotate, profiler
+            )
+        )
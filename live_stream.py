@@ -0,0 +1,321 @@
+import argparse
+import asyncio
+from collections import deque
+from contextlib import suppress
+from functools import partial
+from threading import Condition, Thread
+from time import perf_counter, sleep
+from typing import AsyncIterable, Iterable, NamedTuple
+import cv2 as cv
+import numpy as np
+import marker_detector as mkdtct
+from marker_detector import MarkerDetection
+
+# Policies deciding which frames are skipped when the detection falls behind:
+# "none" never skips a frame and slows the source down instead, "stale" skips
+# the frames which waited longer than the latency budget, and "latest" always
+# jumps to the newest frame.
+DROP_POLICIES = ("none", "stale", "latest")
+# Seconds a closed stream waits for its reader thread to stop.
+_READER_JOIN_TIMEOUT = 1.0
+
+
+class StreamResult(NamedTuple):
+    """Detections of a frame of a stream, with the time it took to produce them."""
+
+    index: int
+    frame: np.ndarray
+    detections: list[MarkerDetection]
+    latency: float
+    dropped: int
+
+
+class _FrameBuffer:
+    """Frames received from the source and waiting for the detection, with the
+    drop policy applied to them. It does no locking of its own.
+    """
+
+    def __init__(self, size: int, latencyBudget: float, dropPolicy: str) -> None:
+        if dropPolicy not in DROP_POLICIES:
+            raise ValueError(
+                f"Unknown drop policy {dropPolicy!r}, expected one of {DROP_POLICIES}."
+            )
+        self.size = size
+        self.latencyBudget = latencyBudget
+        self.dropPolicy = dropPolicy
+        self.pending = deque()
+        self.dropped = 0
+        self.ended = False
+        self.error = None
+
+    def isFull(self) -> bool:
+        # Only the "none" policy makes the source wait for a free place.
+        return self.dropPolicy == "none" and len(self.pending) >= self.size
+
+    def push(self, index: int, frame: np.ndarray) -> None:
+        if len(self.pending) >= self.size:
+            self.pending.popleft()
+            self.dropped += 1
+        self.pending.append((index, perf_counter(), frame))
+
+    def take(self) -> tuple:
+        """Next frame to be processed, skipping the ones the policy drops. The
+        newest frame is never dropped.
+
+        Returns:
+            tuple: index, arrival time and frame, and the number of frames dropped
+            since the previous one.
+        """
+        if self.dropPolicy == "latest":
+            while len(self.pending) > 1:
+                self.pending.popleft()
+                self.dropped += 1
+        elif self.dropPolicy == "stale" and self.latencyBudget is not None:
+            now = perf_counter()
+            while (
+                len(self.pending) > 1 and now - self.pending[0][1] > self.latencyBudget
+            ):
+                self.pending.popleft()
+                self.dropped += 1
+        dropped, self.dropped = self.dropped, 0
+        return (*self.pending.popleft(), dropped)
+
+
+def streamDetections(
+    frames: Iterable[np.ndarray],
+    detect=None,
+    latencyBudget: float = None,
+    dropPolicy: str = "stale",
+    bufferSize: int = 8,
+    annotate: bool = False,
+) -> Iterable[StreamResult]:
+    """Detect the markers of the frames coming from a live source, yielding the
+    results frame by frame.
+
+    The source is consumed by a background thread as fast as it delivers, so a
+    camera is never slowed down by the detection. When the detection falls
+    behind, the frames are skipped according to the drop policy, and whenever the
+    buffer is full its oldest frame is dropped, unless the policy is "none".
+    Closing the generator early doesn't wait for a stalled source: the reader
+    thread, a daemon, exits as soon as the source delivers its next frame.
+
+    Args:
+        frames (Iterable[np.ndarray]): source of the frames, such as captureFrames.
+        detect (optional): callable detecting the markers of a frame, with the
+        signature of detectAndLabelMarkers, such as the detect method of a tracker.
+        If None, detectAndLabelMarkers is used. Defaults to None.
+        latencyBudget (float, optional): maximum time, in seconds, a frame can wait
+        before being dropped by the "stale" policy, or None to wait indefinitely.
+        Defaults to None.
+        dropPolicy (str, optional): one of DROP_POLICIES. Defaults to "stale".
+        bufferSize (int, optional): maximum number of frames waiting for the
+        detection. Defaults to 8.
+        annotate (bool, optional): whether to draw the markers on the frames, if
+        detect is None. Defaults to False.
+
+    Yields:
+        StreamResult: frame index in the source, frame, detections, time in
+        seconds from the arrival of the frame to its detections, and number of
+        frames dropped since the previous result.
+
+    Raises:
+        ValueError: if the drop policy is unknown.
+    """
+    buffer = _FrameBuffer(bufferSize, latencyBudget, dropPolicy)
+    condition = Condition()
+    if detect is None:
+        detect = partial(mkdtct.detectAndLabelMarkers, annotate=annotate)
+
+    def read() -> None:
+        try:
+            for index, frame in enumerate(frames):
+                with condition:
+                    while buffer.isFull() and not buffer.ended:
+                        condition.wait()
+                    if buffer.ended:
+                        return
+                    buffer.push(index, frame)
+                    condition.notify_all()
+        except BaseException as error:
+            buffer.error = error
+        finally:
+            with condition:
+                buffer.ended = True
+                condition.notify_all()
+
+    reader = Thread(target=read, daemon=True)
+    reader.start()
+    try:
+        while True:
+            with condition:
+                while not buffer.pending and not buffer.ended:
+                    condition.wait()
+                if not buffer.pending:
+                    break
+                index, arrival, frame, dropped = buffer.take()
+                condition.notify_all()
+            detections = detect(image=frame, currentFrame=index)
+            yield StreamResult(
+                index, frame, detections, perf_counter() - arrival, dropped
+            )
+        if buffer.error is not None:
+            raise buffer.error
+    finally:
+        # Stop the reader if the consumer leaves early: it exits as soon as the
+        # source delivers its next frame, so a stalled source is not waited for.
+        with condition:
+            buffer.ended = True
+            condition.notify_all()
+        reader.join(_READER_JOIN_TIMEOUT)
+
+
+async def streamDetectionsAsync(
+    frames: AsyncIterable[np.ndarray],
+    detect=None,
+    latencyBudget: float = None,
+    dropPolicy: str = "stale",
+    bufferSize: int = 8,
+    annotate: bool = False,
+) -> AsyncIterable[StreamResult]:
+    """Asynchronous version of streamDetections, for sources which are async
+    iterators. The source is consumed by a task of the event loop, while the
+    detection runs in a worker thread, so the loop stays responsive.
+
+    Args:
+        frames (AsyncIterable[np.ndarray]): source of the frames.
+        detect (optional): callable detecting the markers of a frame, with the
+        signature of detectAndLabelMarkers. If None, detectAndLabelMarkers is used.
+        Defaults to None.
+        latencyBudget (float, optional): maximum time, in seconds, a frame can wait
+        before being dropped by the "stale" policy, or None to wait indefinitely.
+        Defaults to None.
+        dropPolicy (str, optional): one of DROP_POLICIES. Defaults to "stale".
+        bufferSize (int, optional): maximum number of frames waiting for the
+        detection. Defaults to 8.
+        annotate (bool, optional): whether to draw the markers on the frames, if
+        detect is None. Defaults to False.
+
+    Yields:
+        StreamResult: as in streamDetections.
+
+    Raises:
+        ValueError: if the drop policy is unknown.
+    """
+    buffer = _FrameBuffer(bufferSize, latencyBudget, dropPolicy)
+    condition = asyncio.Condition()
+    if detect is None:
+        detect = partial(mkdtct.detectAndLabelMarkers, annotate=annotate)
+
+    async def read() -> None:
+        try:
+            index = 0
+            async for frame in frames:
+                async with condition:
+                    await condition.wait_for(
+                        lambda: not buffer.isFull() or buffer.ended
+                    )
+                    if buffer.ended:
+                        return
+                    buffer.push(index, frame)
+                    condition.notify_all()
+                index += 1
+        except Exception as error:
+            buffer.error = error
+        finally:
+            async with condition:
+                buffer.ended = True
+                condition.notify_all()
+
+    reader = asyncio.ensure_future(read())
+    try:
+        while True:
+            async with condition:
+                await condition.wait_for(lambda: buffer.pending or buffer.ended)
+                if not buffer.pending:
+                    break
+                index, arrival, frame, dropped = buffer.take()
+                condition.notify_all()
+            detections = await asyncio.to_thread(
+                detect, image=frame, currentFrame=index
+            )
+            yield StreamResult(
+                index, frame, detections, perf_counter() - arrival, dropped
+            )
+        if buffer.error is not None:
+            raise buffer.error
+    finally:
+        reader.cancel()
+        with suppress(asyncio.CancelledError):
+            await reader
+
+
+def captureFrames(source, realTime: bool = False) -> Iterable[np.ndarray]:
+    """Frames of a camera, a pipe or a video file.
+
+    Args:
+        source: index of a camera, or path or url of a video, as accepted by
+        cv.VideoCapture.
+        realTime (bool, optional): whether to deliver the frames of a file at its
+        frame rate, so that it stands in for a live capture. Defaults to False.
+
+    Yields:
+        np.ndarray: frames of the source.
+
+    Raises:
+        OSError: if the source can't be opened.
+    """
+    vidcap = cv.VideoCapture(source)
+    if not vidcap.isOpened():
+        raise OSError(f"Can't open the video source {source}.")
+    framePeriod = 1 / (vidcap.get(cv.CAP_PROP_FPS) or 29.97)
+    start = perf_counter()
+    try:
+        index = 0
+        while True:
+            success, frame = vidcap.read()
+            if not success:
+                break
+            if realTime:
+                sleep(max(0.0, start + index * framePeriod - perf_counter()))
+            yield frame
+            index += 1
+    finally:
+        vidcap.release()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Detect the markers of a live source, reporting the latency."
+    )
+    parser.add_argument(
+        "source", help="index of a camera, or path of a video played in real time"
+    )
+    parser.add_argument(
+        "--latency-budget",
+        type=float,
+        default=0.1,
+        help="seconds a frame can wait before being dropped",
+    )
+    parser.add_argument("--drop-policy", choices=DROP_POLICIES, default="stale")
+    args = parser.parse_args()
+
+    source = int(args.source) if args.source.isdigit() else args.source
+    latencies = []
+    dropped = 0
+    for result in streamDetections(
+        captureFrames(source, realTime=not isinstance(source, int)),
+        latencyBudget=args.latency_budget,
+        dropPolicy=args.drop_policy,
+    ):
+        latencies.append(result.latency * 1000)
+        dropped += result.dropped
+        print(
+            f"frame {result.index}: {len(result.detections)} markers, "
+            f"{result.latency * 1000:.1f} ms"
+        )
+    if latencies:
+        print(
+            f"{len(latencies)} frames processed, {dropped} dropped, latency p50 "
+            f"{np.percentile(latencies, 50):.1f} ms, p99 "
+            f"{np.percentile(latencies, 99):.1f} ms"
+        )
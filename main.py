@@ -1,77 +1,523 @@
+from functools import partial
+from queue import Queue, Empty, Full
+from threading import Thread, Event
 from numpy import ndarray
 from cv2 import (
     VideoCapture,
     VideoWriter,
     VideoWriter_fourcc,
+    CAP_PROP_FPS,
     CAP_PROP_FRAME_COUNT,
+    CAP_PROP_POS_FRAMES,
     # imshow,
     # waitKey,
     destroyAllWindows,
 )
 import marker_detector as mkdtct
+import parallel_detector as pdtct
+from frame_reader import FrameBufferPool, captureFrameShape, readInto
+from keyframe_sampler import KeyframeSampler
+from annotation_replay import replayCsvAnnotations
+from checkpoint import (
+    CheckpointedCsvSink,
+    ResultCache,
+    readCheckpoint,
+    runParameters,
+    videoIdentity,
+)
+from result_sink import CsvResultSink
+from stage_profiler import StageProfiler, NULL_PROFILER
+
+# Polling period (in seconds) used by the pipeline stages while waiting on a
+# queue, so that a failure in any stage can stop the others promptly.
+_QUEUE_POLL_TIMEOUT = 0.1
+
+
+def _putUntilStopped(outQueue: Queue, item, stopEvent: Event) -> bool:
+    """Put the item in the queue, waiting for a free slot unless the pipeline
+    is being stopped.
+
+    Args:
+        outQueue (Queue): bounded queue towards the next stage.
+        item: item to forward.
+        stopEvent (Event): set when the pipeline must stop.
+
+    Returns:
+        bool: True if the item was queued, False if the pipeline was stopped.
+    """
+    while not stopEvent.is_set():
+        try:
+            outQueue.put(item, timeout=_QUEUE_POLL_TIMEOUT)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def _getUntilStopped(inQueue: Queue, stopEvent: Event):
+    """Get the next item from the queue, waiting for it unless the pipeline
+    is being stopped.
+
+    Args:
+        inQueue (Queue): bounded queue from the previous stage.
+        stopEvent (Event): set when the pipeline must stop.
+
+    Returns:
+        The next item, or None if the stream ended or the pipeline was stopped.
+    """
+    while not stopEvent.is_set():
+        try:
+            return inQueue.get(timeout=_QUEUE_POLL_TIMEOUT)
+        except Empty:
+            pass
+    return None
+
+
+def _runStage(stage, stopEvent: Event, errors: list, *args) -> None:
+    """Run a pipeline stage, recording its failure and stopping the whole
+    pipeline if it raises.
+    """
+    try:
+        stage(*args, stopEvent)
+    except BaseException as error:
+        errors.append(error)
+        stopEvent.set()
+
+
+def _readStage(
+    vidcap: VideoCapture,
+    framesCount: int,
+    startFrame: int,
+    pool: FrameBufferPool,
+    outQueue: Queue,
+    profiler,
+    stopEvent: Event,
+) -> None:
+    """Decode the frames of the video into the free buffers of the pool, and
+    forward the slot of each of them, paired with the frame index, to the
+    detection stage. A None item marks the end of the stream.
+    """
+    for index in range(startFrame, framesCount):
+        # Wait for the writer to give a buffer back, unless the pipeline stops.
+        while (slot := pool.acquire(_QUEUE_POLL_TIMEOUT)) is None:
+            if stopEvent.is_set():
+                return
+        stageStart = profiler.now()
+        success = readInto(vidcap, pool.buffers[slot])
+        profiler.record("decode", stageStart)
+        if not success:
+            pool.release(slot)
+            break
+        if not _putUntilStopped(outQueue, (index, slot), stopEvent):
+            return
+    _putUntilStopped(outQueue, None, stopEvent)
+
+
+def _detectStage(
+    detect,
+    pool: FrameBufferPool,
+    inQueue: Queue,
+    outQueue: Queue,
+    profiler,
+    stopEvent: Event,
+) -> None:
+    """Detect and label the markers of every incoming frame through the detect
+    callable, annotating it in its buffer, then forward the slot of the frame
+    and its detections to the writing stage. A None item marks the end of the
+    stream.
+    """
+    while (item := _getUntilStopped(inQueue, stopEvent)) is not None:
+        index, slot = item
+        stageStart = profiler.now()
+        detections = detect(
+            image=pool.buffers[slot], currentFrame=index, profiler=profiler
+        )
+        profiler.record("detect", stageStart)
+        if not _putUntilStopped(outQueue, (index, slot, detections), stopEvent):
+            return
+    _putUntilStopped(outQueue, None, stopEvent)
+
+
+def _sampleStage(
+    sampler: KeyframeSampler,
+    annotate: bool,
+    pool: FrameBufferPool,
+    inQueue: Queue,
+    outQueue: Queue,
+    profiler,
+    stopEvent: Event,
+) -> None:
+    """Push every incoming frame to the keyframe sampler, and forward the slots
+    of the frames it hands out, with their detections, to the writing stage. A
+    None item marks the end of the stream.
+    """
+    # The sampler holds the frames until their markers are known.
+    heldSlots = {}
+
+    def forward(resolved: list[tuple]) -> bool:
+        for index, _, detections in resolved:
+            item = (index, heldSlots.pop(index), detections)
+            if not _putUntilStopped(outQueue, item, stopEvent):
+                return False
+        return True
+
+    while (item := _getUntilStopped(inQueue, stopEvent)) is not None:
+        index, slot = item
+        heldSlots[index] = slot
+        if not forward(sampler.push(index, pool.buffers[slot], annotate, profiler)):
+            return
+    if stopEvent.is_set() or not forward(sampler.flush(annotate, profiler)):
+        return
+    _putUntilStopped(outQueue, None, stopEvent)
 
 
-def detectMarkerAndTrack(objectToTrack: int) -> ndarray:
-    # Initialize both video reader and writer.
-    videoCapPath = f"../data/obj0{objectToTrack}.mp4"
-    # ! I open the file in a write mode and if it doesn't exist it will be created.
-    f = open(f"obj{objectToTrack}_marker.csv", "w")
-    # ! I write a header to it.
-    f.write("FRAME, MARK_ID,   Px,   Py,    X,    Y, Z\n")
-    f.close()
-    # ! I'm creating a VideoCapture object from the input video file specified by videoCapPath.
-    vidcap = VideoCapture(videoCapPath)
-    storedFrames = []  # ! initialized an empty list
-    success, frame = vidcap.read()  # ! I'm reading the first frame.
+def _detectInPipeline(
+    vidcap: VideoCapture,
+    framesCount: int,
+    videoWriter: VideoWriter,
+    sink,
+    detect,
+    queueSize: int,
+    profiler=NULL_PROFILER,
+    startFrame: int = 0,
+    sampler: KeyframeSampler = None,
+) -> None:
+    """Detect and label the markers of the video through a streaming pipeline.
+
+    The reader and the detector run in background threads, while the writer
+    runs in the calling thread: OpenCV releases the GIL while decoding,
+    processing and encoding, so the three stages overlap. The frames are
+    decoded in place into a pool of 2 * queueSize + 3 preallocated buffers,
+    enough to fill both queues while every stage holds a frame: the writer
+    releases each buffer once its frame has been encoded, so the decoder reuses
+    it and no memory is allocated per frame.
+
+    Args:
+        vidcap (VideoCapture): opened input video.
+        framesCount (int): number of frames to process.
+        videoWriter (VideoWriter): writer of the annotated video, or None to skip
+        the encoding.
+        sink: result sink receiving the detections of every frame.
+        detect: callable detecting and labelling the markers of a frame.
+        queueSize (int): maximum number of frames waiting between two stages.
+        profiler (optional): stage_profiler.StageProfiler recording the time spent
+        in each stage. Defaults to NULL_PROFILER, which records nothing.
+        startFrame (int, optional): index of the first frame to process, where the
+        video is positioned. Defaults to 0.
+        sampler (KeyframeSampler, optional): if given, detect is ignored and the
+        markers are detected on keyframes only and interpolated in between. The
+        pool holds interval more buffers, for the frames waiting for the next
+        keyframe. Defaults to None.
+    """
+    buffersCount = 2 * queueSize + 3
+    if sampler is not None:
+        buffersCount += sampler.interval
+    pool = FrameBufferPool(buffersCount, captureFrameShape(vidcap))
+    decodedFrames = Queue(maxsize=queueSize)
+    annotatedFrames = Queue(maxsize=queueSize)
+    stopEvent = Event()
+    errors = []
+    if sampler is None:
+        detectStage = (_detectStage, stopEvent, errors, detect)
+    else:
+        annotate = videoWriter is not None
+        detectStage = (_sampleStage, stopEvent, errors, sampler, annotate)
+    stages = [
+        Thread(
+            target=_runStage,
+            args=(
+                _readStage,
+                stopEvent,
+                errors,
+                vidcap,
+                framesCount,
+                startFrame,
+                pool,
+                decodedFrames,
+                profiler,
+            ),
+            daemon=True,
+        ),
+        Thread(
+            target=_runStage,
+            args=(
+                *detectStage,
+                pool,
+                decodedFrames,
+                annotatedFrames,
+                profiler,
+            ),
+            daemon=True,
+        ),
+    ]
+    for stage in stages:
+        stage.start()
+
+    # If you want to view the video while being modified in real time,
+    # uncomment the following commented lines, and also the releated
+    # imports at the beginning.
+    try:
+        while (item := _getUntilStopped(annotatedFrames, stopEvent)) is not None:
+            index, slot, detections = item
+            frame = pool.buffers[slot]
+            stageStart = profiler.now()
+            sink.write(index, detections)
+            stageStart = profiler.record("sink", stageStart)
+            # imshow("Marker Detection and Tracking", frame)
+            if videoWriter is not None:
+                videoWriter.write(frame)
+                profiler.record("encode", stageStart)
+            pool.release(slot)
+            # k = waitKey(30) & 0xFF
+            # if k == 27:
+            #     break
+    finally:
+        # Unblock the other stages if the writer stopped early, and wait for them.
+        stopEvent.set()
+        for stage in stages:
+            stage.join()
+        # destroyAllWindows()
+
+    if errors:
+        raise errors[0]
+
+
+def trackVideo(
+    videoPath: str,
+    csvPath: str,
+    outputVideoPath: str,
+    queueSize: int = 8,
+    workers: int = 0,
+    chunkSize: int = 4,
+    sink=None,
+    flushInterval: int = 100,
+    roi: tuple[int] = mkdtct.MARKERS_ROI,
+    tracker=None,
+    headless: bool = False,
+    profilePath: str = None,
+    checkpoint: bool = False,
+    cacheDir: str = None,
+    keyframeInterval: int = 0,
+    maxResidual: float = 2.0,
+) -> None:
+    """Detect and label the markers in every frame of a video, writing their
+    coordinates in a csv file and the annotated video in another file.
+
+    By default decoding, detection and encoding run as a streaming pipeline: each
+    stage lives in its own thread and the stages are linked by bounded queues, so
+    every frame is encoded as soon as it has been annotated, and the memory usage
+    stays flat no matter how long the video is. With more than one worker, the
+    detection is instead spread over a pool of processes, and the results are
+    reassembled in frame order.
+
+    The detections are handed to a result sink, which by default buffers them and
+    writes them to the csv file every flushInterval frames. In headless mode the
+    frames are neither annotated nor encoded, and only the detections are
+    produced: the annotated video can be obtained later from them through
+    annotation_replay.replayCsvAnnotations.
+
+    Args:
+        videoPath (str): path of the input video.
+        csvPath (str): path of the csv file written by the default sink.
+        outputVideoPath (str): path of the annotated video, ignored in headless
+        mode.
+        queueSize (int, optional): maximum number of frames waiting between two
+        consecutive stages of the streaming pipeline. Defaults to 8.
+        workers (int, optional): number of worker processes running the detection.
+        With 0 or 1 the streaming pipeline is used. Defaults to 0.
+        chunkSize (int, optional): number of consecutive frames sent at once to a
+        worker process. Defaults to 4.
+        sink (optional): result sink receiving the detections of every frame through
+        its write(frame, detections) method. It is flushed, but not closed, at the
+        end of the run. If None, a CsvResultSink writing the csv file is used.
+        Defaults to None.
+        flushInterval (int, optional): number of frames buffered by the default csv
+        sink before writing them. Defaults to 100.
+        roi (tuple[int], optional): region (x0, y0, x1, y1) where the markers are
+        searched, or None for the whole frame. Defaults to MARKERS_ROI.
+        tracker (optional): stateful detector carrying information from a frame to
+        the next one, such as a roi_tracker.TemporalRoi, which narrows the region of
+        interest around the previous detections, or a marker_tracker.MarkerTracker,
+        which tracks the markers between full detections. Its detect(image,
+        currentFrame) method is used in place of detectAndLabelMarkers, and roi is
+        ignored. It requires the sequential pipeline. Defaults to None.
+        headless (bool, optional): whether to skip the annotation of the frames and
+        the encoding of the output video. Defaults to False.
+        profilePath (str, optional): path of a json file where the timing
+        histograms of every stage (decoding, detection and its sub-stages, sink,
+        encoding) and the number of contours, polygons and markers per frame are
+        written at the end of the run. If None, nothing is measured. Defaults to
+        None.
+        checkpoint (bool, optional): whether to make the run resumable. With the
+        default sink, a checkpoint is recorded next to the csv file every
+        flushInterval frames, and a run interrupted by a crash or a pre-emption is
+        resumed from its last checkpoint, seeking to the following frame. An
+        annotated video can't be resumed, so it is produced by replaying the csv
+        file at the end of a resumed run. Defaults to False.
+        cacheDir (str, optional): directory caching the results of the runs, keyed
+        on the content of the video and on roi and tracker. If the video was
+        already processed with the same parameters, the results are copied from
+        the cache without decoding it. The results are stored only when the
+        default sink is used. If None, nothing is cached. Defaults to None.
+        keyframeInterval (int, optional): if at least 2, the markers are detected
+        on one frame every keyframeInterval, and on the frame halfway between two
+        of them, and their corners are interpolated on the other frames through
+        a keyframe_sampler.KeyframeSampler. If a marker appears or disappears, or
+        if the interpolation misses the halfway frame by more than maxResidual
+        pixels, each half of the interval is checked in the same way, down to
+        full rate. It requires the sequential pipeline, without tracker. With 0
+        or 1, every frame is detected. Defaults to 0.
+        maxResidual (float, optional): maximum distance, in pixels, between the
+        detected and the interpolated corners of the halfway frame. Defaults to
+        2.0.
+
+    Raises:
+        ValueError: if a tracker or the keyframe sampling is used with multiple
+        workers, or if both are used together.
+        OSError: if the input video can't be opened.
+    """
+    if tracker is not None and workers > 1:
+        raise ValueError(
+            "A tracker requires the frames to be processed in order, so it can't "
+            "be used with multiple workers."
+        )
+    sampler = None
+    if keyframeInterval > 1:
+        if workers > 1 or tracker is not None:
+            raise ValueError(
+                "The keyframe sampling requires the frames to be processed in order "
+                "by detectAndLabelMarkers, so it can't be used with multiple "
+                "workers or with a tracker."
+            )
+        sampler = KeyframeSampler(keyframeInterval, maxResidual, roi)
+
+    parameters = runParameters(roi, tracker, sampler)
+    cache = cacheKey = None
+    if cacheDir is not None:
+        cache = ResultCache(cacheDir)
+        cacheKey = ResultCache.key(videoPath, parameters)
+        if cache.load(
+            cacheKey,
+            csvPath if sink is None else None,
+            sink,
+            None if headless else outputVideoPath,
+        ):
+            if sink is not None:
+                sink.flush()
+            return
+
+    # ! I'm creating a VideoCapture object from the input video file specified by videoPath.
+    vidcap = VideoCapture(videoPath)
+    if not vidcap.isOpened():
+        raise OSError(f"Can't open the video {videoPath}.")
     framesCount = int(
         vidcap.get(CAP_PROP_FRAME_COUNT)
     )  # ! Getting the total number of frames.
+    # The default sink opens the csv file in write mode, creating it if it
+    # doesn't exist, and writes its header, unless an interrupted run is resumed.
+    ownedSink = None
+    startFrame = 0
+    replayVideo = False
+    if sink is None and checkpoint:
+        run = {"video": videoIdentity(videoPath), "parameters": parameters}
+        sink = ownedSink = CheckpointedCsvSink(
+            csvPath, run, flushInterval, readCheckpoint(csvPath, run)
+        )
+        startFrame = sink.nextFrame
+        if startFrame > 0:
+            vidcap.set(CAP_PROP_POS_FRAMES, startFrame)
+            replayVideo = not headless
+            headless = True
+    elif sink is None:
+        sink = ownedSink = CsvResultSink(csvPath, flushInterval)
     videoFormat = VideoWriter_fourcc(
         "m", "p", "4", "v"
     )  # ! Setting the video format to "mp4v"
-    videoWriterPath = (
-        "../data/obj" + str(objectToTrack) + "_marker.mp4"
-    )  # ! Setting the output video file path.
     # ! I'm creating the VideoWriter object using the specified video format,
-    # ! frame rate and frame size.
-    videoWriter = VideoWriter(
-        videoWriterPath,
-        videoFormat,  # Every output-video will be produced in this format.
-        29.97,  # Every input-video has this frame rate.
-        (1920, 1080),  # Every input-video has these shapes.
-    )
+    # ! frame rate and frame size, unless no video has to be produced.
+    videoWriter = None
+    if not headless:
+        frameHeight, frameWidth, _ = captureFrameShape(vidcap)
+        videoWriter = VideoWriter(
+            outputVideoPath,
+            videoFormat,  # Every output-video will be produced in this format.
+            vidcap.get(CAP_PROP_FPS) or 29.97,  # Frame rate of the input-video.
+            (frameWidth, frameHeight),  # Frame size of the input-video.
+        )
 
-    # If you want to view the video while being modified in real time,
-    # uncomment the following commented lines, and also the releated
-    # imports at the beginning.
-    # ! This loop iterates over all frames of the input video. For each frame,
-    # ! it calls the detectAndLabelMarkers() function to detect and label
-    # ! markers in the frame, appends the frame to the storedFrames list, and
-    # ! reads the next frame using the read() method of the VideoCapture object.
-    # ! Once all frames have been processed, it releases the VideoCapture object
-    # ! using the release() method.
-    for index in range(0, framesCount):
-        if success:
-            mkdtct.detectAndLabelMarkers(
-                image=frame, currentFrame=index, objectToTrack=objectToTrack
+    profiler = NULL_PROFILER if profilePath is None else StageProfiler()
+
+    try:
+        if workers > 1:
+            pdtct.detectInParallel(
+                vidcap,
+                framesCount,
+                videoWriter,
+                sink,
+                workers,
+                chunkSize,
+                roi,
+                profiler,
+                startFrame,
             )
-            # imshow("Marker Detection and Tracking", frame)
-            storedFrames.append(frame)
-            # k = waitKey(30) & 0xFF
-            success, frame = vidcap.read()
-            # if k == 27:
-            #     break
         else:
-            break
-    vidcap.release()
+            if tracker is not None:
+                detect = partial(tracker.detect, annotate=not headless)
+            else:
+                detect = partial(
+                    mkdtct.detectAndLabelMarkers, roi=roi, annotate=not headless
+                )
+            _detectInPipeline(
+                vidcap,
+                framesCount,
+                videoWriter,
+                sink,
+                detect,
+                queueSize,
+                profiler,
+                startFrame,
+                sampler,
+            )
+        if profilePath is not None:
+            profiler.exportJson(profilePath)
+    finally:
+        vidcap.release()
+        if videoWriter is not None:
+            videoWriter.release()
+        if ownedSink is not None:
+            ownedSink.close()
+        else:
+            sink.flush()
+
+    if checkpoint and ownedSink is not None:
+        ownedSink.complete()
+    if replayVideo:
+        replayCsvAnnotations(videoPath, csvPath, outputVideoPath)
+    if cache is not None and ownedSink is not None:
+        cache.store(
+            cacheKey,
+            csvPath,
+            framesCount,
+            outputVideoPath if videoWriter is not None or replayVideo else None,
+        )
 
-    # destroyAllWindows()
 
-    # ! Loop over all frames stored in storedFrames list and write each frame to
-    # ! the output video file using the write method. And then realese the VideoWriter object.
-    _ = [videoWriter.write(frame) for frame in storedFrames]
+def detectMarkerAndTrack(objectToTrack: int, **options) -> ndarray:
+    """Detect and label the markers in every frame of the chosen video, writing
+    their coordinates in "obj{objectToTrack}_marker.csv" and the annotated video
+    in "../data/obj{objectToTrack}_marker.mp4".
 
-    videoWriter.release()
+    Args:
+        objectToTrack (int): index of the chosen video.
+        **options: keyword arguments of trackVideo, such as the number of workers,
+        the result sink, the tracker or the headless mode.
+    """
+    trackVideo(
+        f"../data/obj0{objectToTrack}.mp4",
+        f"obj{objectToTrack}_marker.csv",
+        "../data/obj" + str(objectToTrack) + "_marker.mp4",
+        **options,
+    )
 
 
 if __name__ == "__main__":
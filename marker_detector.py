@@ -1,6 +1,50 @@
 import cv2 as cv
 import numpy as np
 from math import cos, sin, radians
+from threading import local
+from typing import NamedTuple
+from stage_profiler import NULL_PROFILER
+
+# Region of interest (x0, y0, x1, y1) where the markers are searched: the part
+# of the image on the left is discarded because the smallest visible markers
+# tend to be misdetected being them adjacent to the plastic cup.
+MARKERS_ROI = (1200, 0, 1920, 1080)
+
+
+def markerWorldCoordinates(markerId: int) -> tuple[float]:
+    """Real-world coordinates of a marker, which lie on the turn-table.
+
+    Args:
+        markerId (int): label of the marker.
+
+    Returns:
+        tuple[float]: (X, Y, Z) coordinates of the marker.
+    """
+    # ! radians convert angle x from degrees to radians.
+    # ! FIXME: Why is it "-15"?
+    radAngle = radians(-15)
+    return cos(radAngle * markerId) * 70, sin(radAngle * markerId) * 70, 0.0
+
+
+# Real-world coordinates of every label which can be decoded from the 5 circles
+# of a marker, so they are never computed again during the detection.
+MARKER_WORLD_COORDINATES = tuple(
+    markerWorldCoordinates(markerId) for markerId in range(32)
+)
+
+
+class MarkerDetection(NamedTuple):
+    """Marker identified in a frame, together with its pixel coordinates (the
+    concave corner of the marker) and its real-world coordinates.
+    """
+
+    frame: int
+    markerId: int
+    px: int
+    py: int
+    x: float
+    y: float
+    z: float
 
 
 # ! Generates a list of point represeting a line between the two given points.
@@ -150,6 +194,124 @@ def bresenhamLineGenerator(x0, y0, x1, y1):
     return linePixel
 
 
+def sampleMarkerAxes(
+    gray: np.ndarray,
+    startPoints: np.ndarray,
+    endPoints: np.ndarray,
+    origin: tuple[int] = (0, 0),
+    blackLevel: int = 180,
+    firstCorrection: float = 0.9,
+    correction: float = 0.85,
+) -> tuple[np.ndarray]:
+    """Sample the axes of many markers at once, and decode their labels.
+
+    Each axis goes from the concave corner to the middle point of the lower
+    side of a marker. Instead of generating every pixel of the axis through
+    bresenhamLineGenerator, the pixels which would be found at the sampled
+    indices of such line are computed in closed form, so the result is exactly
+    the one of the pixel-by-pixel generation: in a Bresenham line the minor
+    coordinate advances floor((2 * minor * t + major) / (2 * major)) times in
+    the first t steps.
+
+    Args:
+        gray (np.ndarray): grayscale image.
+        startPoints (np.ndarray): (N, 2) concave corners of the markers.
+        endPoints (np.ndarray): (N, 2) middle points of the lower sides.
+        origin (tuple[int], optional): full-frame coordinates of the top-left
+        pixel of gray, when it is cropped. The samples falling outside of gray
+        are read as black. Defaults to (0, 0).
+        blackLevel (int, optional): gray level up to which a sample is black.
+        Defaults to 180.
+        firstCorrection (float, optional): perspective correction of the index of
+        the first sample. Defaults to 0.9.
+        correction (float, optional): perspective correction of the indices of the
+        samples from the second to the fifth. Defaults to 0.85.
+
+    Returns:
+        tuple[np.ndarray]: (N,) labels of the markers, (N, K, 2) sampled points
+        and (N, K) mask of the valid samples. A marker whose axis is too short
+        to be sampled has no valid samples.
+    """
+    if len(startPoints) == 0:
+        return (
+            np.empty(0, dtype=np.int64),
+            np.empty((0, 0, 2), dtype=np.int64),
+            np.empty((0, 0), dtype=bool),
+        )
+    x0, y0 = startPoints.astype(np.int64).T
+    x1, y1 = endPoints.astype(np.int64).T
+    dx = np.abs(x1 - x0)
+    dy = np.abs(y1 - y0)
+
+    # Same steps chosen by bresenhamLineGenerator, where the slope is
+    # dy / dx, or 10 if dx is zero.
+    slopeSmallerThanOne = dy < dx
+    slopeGreaterThanOne = (dy > dx) | (dx == 0)
+    yStep = np.where(~slopeSmallerThanOne & (y0 > y1), -1, 1)
+    xStep = np.where(
+        (slopeSmallerThanOne & ((x0 > x1) | (y0 > y1)))
+        | (slopeGreaterThanOne & (x0 > x1) & (y0 > y1))
+        | ((x0 > x1) & (y0 < y1)),
+        -1,
+        1,
+    )
+    major = np.where(slopeSmallerThanOne, dx, dy)
+    minor = np.where(slopeSmallerThanOne, dy, dx)
+
+    # Indices of the samples along each line. A little correction is applied
+    # on the place where to look for the white circles: theoretically, the
+    # line should be splitted into 5 pieces, and the detection of each circle
+    # should be made by looking into the centers of such pieces, but the line
+    # is perspectively warped, so an adjustment is required when looking for
+    # each circle's center.
+    axisLen = major + 1
+    cycleJump = (axisLen / 10 * 1.95).astype(np.int64)
+    samplesCount = np.where(cycleJump > 0, (axisLen - 1) // np.maximum(cycleJump, 1), 0)
+    sampleSlots = np.arange(samplesCount.max())
+    corrections = np.ones(len(sampleSlots))
+    corrections[0:1] = firstCorrection
+    corrections[1:5] = correction
+    validSamples = sampleSlots < samplesCount[:, None]
+    sampleIndices = np.where(
+        validSamples,
+        (cycleJump[:, None] * (sampleSlots + 1) * corrections).astype(np.int64),
+        0,
+    )
+
+    majorOffsets = sampleIndices * yStep[:, None]
+    minorOffsets = (
+        (2 * minor[:, None] * sampleIndices + major[:, None])
+        // np.maximum(2 * major[:, None], 1)
+    ) * xStep[:, None]
+    samplesX = x0[:, None] + np.where(
+        slopeSmallerThanOne[:, None], majorOffsets, minorOffsets
+    )
+    samplesY = y0[:, None] + np.where(
+        slopeSmallerThanOne[:, None], minorOffsets, majorOffsets
+    )
+
+    # Store each slot status: white (0) or black (1).
+    # (180 seems a good threshold to discriminate them
+    # according to some prints). The first sample is the least
+    # significant bit.
+    grayX = samplesX - origin[0]
+    grayY = samplesY - origin[1]
+    insideGray = (
+        (grayX >= 0) & (grayX < gray.shape[1]) & (grayY >= 0) & (grayY < gray.shape[0])
+    )
+    sampledValues = np.where(
+        insideGray,
+        gray[
+            np.clip(grayY, 0, gray.shape[0] - 1), np.clip(grayX, 0, gray.shape[1] - 1)
+        ],
+        0,
+    )
+    blackSamples = (sampledValues <= blackLevel) & validSamples
+    markerIds = (blackSamples.astype(np.int64) << sampleSlots).sum(axis=1)
+
+    return markerIds, np.stack((samplesX, samplesY), axis=-1), validSamples
+
+
 def computeDistance(p1, p2):
     """Compute the euclidean distance between p1 and p2.
 
@@ -166,237 +328,784 @@ def computeDistance(p1, p2):
     return ((p2[0] - p1[0]) ** 2 + (p2[1] - p1[1]) ** 2) ** 0.5
 
 
-def detectAndLabelMarkers(
-    image: np.ndarray, currentFrame: int, objectToTrack: int
-) -> None:
-    """Detect the visible markers through their contours and then determine for
-    each of them the line which crosses all the circles from the bottom of the marker
-    to the concave corner. Eventually this line is used to traverse the marker, looking
-    for the white circles in fixed positions.
+def _findConcaveCornerInPolygon(poly: np.ndarray, shortSide: float = 80.0) -> tuple:
+    """Find the concave corner of a single polygon, and the middle point of its
+    lower side. This is the fallback of findConcaveCorners for the polygons which
+    don't have exactly 3 short sides.
 
     Args:
-        image (np.ndarray): input image.
-        currentFrame (int): index of the current image with respect to the total number
-        of frames in the video.
-        objectToTrack (int): index of the chosen video. Required to write the rows in the
-        related csv file.
-    """
+        poly (np.ndarray): (5, 1, 2) polygon returned by cv.approxPolyDP.
+        shortSide (float, optional): length below which a side is short. Defaults
+        to 80.0.
 
-    # ! Initialize an empty string to hold the output file content
-    outputFileContent = ""
-
-    # ! Convert the input image to grayscale
-    gray = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
-
-    # Discarded part of the image because the smallest
-    # visible markers tend to be misdetected being them
-    # adjacent to the plastic cup.
-    gray[:, 0:1200:] = 0
-    # 190 detects markers pretty well, but still requires an
-    # area control for small fake-markers appearing on the plastic
-    # cup.
-    _, thresh = cv.threshold(gray, 190, 255, cv.THRESH_BINARY)
-
-    # I use CHAIN_APPROX_SIMPLE because it removes all redundant points
-    # and compresses the contour, thereby saving memory.
-    # ! Find the contours (i.e., the boundaries) of the white objects in the
-    # ! binary image using a hierarchical contour retrieval mode (RETR_TREE)
-    # ! and compress the contours by removing redundant points to save
-    # ! memory.
-    contours, _ = cv.findContours(thresh, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE)
-
-    # Searching through every region selected to find the required polygon.
-    # ! Find the polygons with 5 vertices (pentagons) among the contours
-    # ! with area greater than 1200. The threshold of 1200 is used to
-    # ! filter out small fake-markers appearing on the plastic cup.
-    polygons = [
-        approx
-        for cnt in contours
-        if cv.contourArea(cnt) > 1200
-        and len(approx := cv.approxPolyDP(cnt, 0.0155 * cv.arcLength(cnt, True), True))
-        == 5
+    Returns:
+        tuple: concave corner and middle point of the lower side, or None if
+        fewer than 3 short sides, or no two short sides sharing a vertex, are
+        found.
+    """
+    # ! Initialize variables to hold the concave corner point and the
+    # ! middle point on the lower side of the marker.
+    concaveCornerPoint = None
+    lowerSideMiddlePoint = None
+    # ! Count the number of vertices in the polygon
+    totalVertices = len(poly)
+    # Retreving the 3 shortest sides for the actual polygon.
+    # I chose 80 as filter because sides larger then 80 are
+    # the long sides, which are not useful for the detection
+    # of A.
+    # ! For each vertex it checks if the distance between the vertex and the next vertex in the
+    # ! polygon is less than 80. If the distance is less than 80, the vertexIndex is added to the list.
+    matchingSides = [
+        vertexIndex
+        for vertexIndex, vertex in enumerate(poly)
+        if computeDistance(vertex[0], poly[(vertexIndex + 1) % totalVertices][0])
+        < shortSide
     ]
-    # ! Draw the polygons found on the original image with a green line
-    # ! of width 2 pixels.
-    cv.drawContours(image, polygons, -1, (0, 255, 0), 2)
-
-    # Cycle through every marker, and find for each of them the point A.
-    # Take the 3 shortest sides of each marker: the A point will be
-    # the one where two of such sides meet.
-    for poly in polygons:
-        # ! Initialize variables to hold the concave corner point and the
-        # ! middle point on the lower side of the marker.
-        concaveCornerPoint = None
-        lowerSideMiddlePoint = None
-        # ! Count the number of vertices in the polygon
-        totalVertices = len(poly)
-        # Retreving the 3 shortest sides for the actual polygon.
-        # I chose 80 as filter because sides larger then 80 are
-        # the long sides, which are not useful for the detection
-        # of A.
-        # ! For each vertex it checks if the distance between the vertex and the next vertex in the
-        # ! polygon is less than 80. If the distance is less than 80, the vertexIndex is added to the list.
-        matchingSides = [
-            vertexIndex
-            for vertexIndex, vertex in enumerate(poly)
-            if computeDistance(vertex[0], poly[(vertexIndex + 1) % totalVertices][0])
-            < 80.0
-        ]
-        # Iterate through the 3 sides and control them by couples to
-        # find which of them match
-        # ! Loop through each side in matchingSides. Set initial values for the four points
-        # ! that define the two sides.
-        for loopIndex, side in enumerate(matchingSides):
-            cornerFound = False
-
-            # Legend:
-            #   - Side: index of the first vertex of the currently examined side.
-            #   - (side + 1) % totalVertices: index of the second vertex of the currently examined side.
-            #   - matchingSides[(loopIndex + 1) % 3]: index of the first vertex of the next matching side.
-            #   - (matchingSides[(loopIndex + 1) % 3] + 1) % totalVertices: index of the second vertex
-            #                                                               of the next matching side.
-            firstSideFirstPoint = poly[side][0]
-            firstSideSecondPoint = poly[(side + 1) % totalVertices][0]
-            secondSideFirstPoint = poly[matchingSides[(loopIndex + 1) % 3]][0]
-            secondSideSecondPoint = poly[
-                (matchingSides[(loopIndex + 1) % 3] + 1) % totalVertices
-            ][0]
-
-            # Check if the two currently examined sides have a common point: if so,
-            # store it for the next operations, and record that the matching lines
-            # have been found for this marker. If no match is found, keep iterating.
-            # ! Check if the two sides intersect at one of their endpoints. If so, set cornerFound
-            # ! to True and store the corner point in concaveCornerPoint.
-            # ! FIXME: check if the defintion is correct
-            # ! I have used the function "all" that checks that all the elements of the array are equal.
-            if (firstSideFirstPoint == secondSideFirstPoint).all() or (
-                firstSideFirstPoint == secondSideSecondPoint
-            ).all():
-                cornerFound = True
-                concaveCornerPoint = firstSideFirstPoint
-            elif (firstSideSecondPoint == secondSideFirstPoint).all() or (
-                firstSideSecondPoint == secondSideSecondPoint
-            ).all():
-                cornerFound = True
-                concaveCornerPoint = firstSideSecondPoint
-
-            # ! If a corner was found, draw a red circle at the corner point.
-            if cornerFound:
+    # The concave corner and the lower side need 3 short sides.
+    if len(matchingSides) < 3:
+        return None
+    # Iterate through the 3 sides and control them by couples to
+    # find which of them match
+    # ! Loop through each side in matchingSides. Set initial values for the four points
+    # ! that define the two sides.
+    for loopIndex, side in enumerate(matchingSides):
+        cornerFound = False
+
+        # Legend:
+        #   - Side: index of the first vertex of the currently examined side.
+        #   - (side + 1) % totalVertices: index of the second vertex of the currently examined side.
+        #   - matchingSides[(loopIndex + 1) % 3]: index of the first vertex of the next matching side.
+        #   - (matchingSides[(loopIndex + 1) % 3] + 1) % totalVertices: index of the second vertex
+        #                                                               of the next matching side.
+        firstSideFirstPoint = poly[side][0]
+        firstSideSecondPoint = poly[(side + 1) % totalVertices][0]
+        secondSideFirstPoint = poly[matchingSides[(loopIndex + 1) % 3]][0]
+        secondSideSecondPoint = poly[
+            (matchingSides[(loopIndex + 1) % 3] + 1) % totalVertices
+        ][0]
+
+        # Check if the two currently examined sides have a common point: if so,
+        # store it for the next operations, and record that the matching lines
+        # have been found for this marker. If no match is found, keep iterating.
+        # ! Check if the two sides intersect at one of their endpoints. If so, set cornerFound
+        # ! to True and store the corner point in concaveCornerPoint.
+        # ! FIXME: check if the defintion is correct
+        # ! I have used the function "all" that checks that all the elements of the array are equal.
+        if (firstSideFirstPoint == secondSideFirstPoint).all() or (
+            firstSideFirstPoint == secondSideSecondPoint
+        ).all():
+            cornerFound = True
+            concaveCornerPoint = firstSideFirstPoint
+        elif (firstSideSecondPoint == secondSideFirstPoint).all() or (
+            firstSideSecondPoint == secondSideSecondPoint
+        ).all():
+            cornerFound = True
+            concaveCornerPoint = firstSideSecondPoint
+
+        # ! If a corner was found, store it together with the middle point of
+        # ! the side opposite to it.
+        if cornerFound:
+            # "A" was found, so I use it to generate a line between it and
+            # the middle point on the lower side of the marker: I use this
+            # line to look in the 5 areas where each circle should reside,
+            # obtaining in such way the binary value of each marker.
+            # ! Calculate the midpoint of the side opposite the concave corner
+            # ! and store it in lowerSideMiddlePoint.
+            lowerSide = (
+                poly[matchingSides[(loopIndex + 2) % 3]][0],
+                poly[(matchingSides[(loopIndex + 2) % 3] + 1) % totalVertices][0],
+            )
+            middlePointX = (lowerSide[0][0] + lowerSide[1][0]) // 2
+            middlePointY = (lowerSide[0][1] + lowerSide[1][1]) // 2
+            lowerSideMiddlePoint = (middlePointX, middlePointY)
+
+            return concaveCornerPoint, lowerSideMiddlePoint
+
+    return None
+
+
+def findConcaveCorners(
+    polygons: list[np.ndarray], shortSide: float = 80
+) -> tuple[np.ndarray]:
+    """Find, for every marker of the frame, the point A (the concave corner) and
+    the middle point of the lower side.
+
+    Take the 3 shortest sides of each marker: the A point will be the one where
+    two of such sides meet, and the lower side will be the remaining one. All
+    the pentagons are stacked in a single (N, 5, 2) array, and the side lengths,
+    the short sides, the shared vertices and the middle points are computed for
+    all of them at once. The polygons which don't have exactly 3 short sides are
+    handled one by one by _findConcaveCornerInPolygon.
+
+    Args:
+        polygons (list[np.ndarray]): (5, 1, 2) polygons returned by cv.approxPolyDP.
+        shortSide (float, optional): length below which a side is short. Defaults
+        to 80.
+
+    Returns:
+        tuple[np.ndarray]: (M, 2) concave corners, (M, 2) middle points of the lower
+        sides and (M,) indices in polygons of the M markers where A was found, in
+        the order of polygons.
+    """
+    if len(polygons) == 0:
+        return (
+            np.empty((0, 2), dtype=np.int32),
+            np.empty((0, 2), dtype=np.int32),
+            np.empty(0, dtype=np.int64),
+        )
+    vertices = np.array(polygons).reshape(-1, 5, 2)
+    nextVertices = np.roll(vertices, -1, axis=1)
+
+    # I chose 80 as filter because sides larger then 80 are
+    # the long sides, which are not useful for the detection
+    # of A. The squared lengths are integers, so comparing them
+    # with the squared threshold is exact for integer thresholds.
+    sideVectors = (nextVertices - vertices).astype(np.int64)
+    shortSides = (sideVectors**2).sum(axis=2) < shortSide**2
+
+    cornerFound = np.zeros(len(vertices), dtype=bool)
+    concaveCornerPoints = np.zeros((len(vertices), 2), dtype=vertices.dtype)
+    lowerSideMiddlePoints = np.zeros((len(vertices), 2), dtype=vertices.dtype)
+
+    regular = shortSides.sum(axis=1) == 3
+    if regular.any():
+        regularIndices = np.flatnonzero(regular)
+        regularVertices = vertices[regular]
+        regularNextVertices = nextVertices[regular]
+        # Indices of the first vertex of the 3 short sides, in ascending order.
+        matchingSides = np.nonzero(shortSides[regular])[1].reshape(-1, 3)
+        rows = np.arange(len(regularVertices))[:, None]
+        sidesFirstPoints = regularVertices[rows, matchingSides]
+        sidesSecondPoints = regularNextVertices[rows, matchingSides]
+
+        # Control the sides by couples, each one with the next one: two sides
+        # match if they share one of their endpoints.
+        secondSidesFirstPoints = np.roll(sidesFirstPoints, -1, axis=1)
+        secondSidesSecondPoints = np.roll(sidesSecondPoints, -1, axis=1)
+        firstPointShared = (sidesFirstPoints == secondSidesFirstPoints).all(axis=2) | (
+            sidesFirstPoints == secondSidesSecondPoints
+        ).all(axis=2)
+        secondPointShared = (sidesSecondPoints == secondSidesFirstPoints).all(
+            axis=2
+        ) | (sidesSecondPoints == secondSidesSecondPoints).all(axis=2)
+        couplesMatching = firstPointShared | secondPointShared
+
+        # The first matching couple wins, as when examining them in order.
+        found = couplesMatching.any(axis=1)
+        firstCouple = couplesMatching.argmax(axis=1)
+        sharedPoints = np.where(
+            firstPointShared[:, :, None], sidesFirstPoints, sidesSecondPoints
+        )
+        lowerSides = (firstCouple + 2) % 3
+        rows = rows[:, 0]
+        middlePoints = (
+            sidesFirstPoints[rows, lowerSides] + sidesSecondPoints[rows, lowerSides]
+        ) // 2
+
+        cornerFound[regularIndices] = found
+        concaveCornerPoints[regularIndices] = sharedPoints[rows, firstCouple]
+        lowerSideMiddlePoints[regularIndices] = middlePoints
+
+    for polyIndex in np.flatnonzero(~regular):
+        result = _findConcaveCornerInPolygon(polygons[polyIndex], shortSide)
+        if result is not None:
+            cornerFound[polyIndex] = True
+            concaveCornerPoints[polyIndex] = result[0]
+            lowerSideMiddlePoints[polyIndex] = result[1]
+
+    return (
+        concaveCornerPoints[cornerFound],
+        lowerSideMiddlePoints[cornerFound],
+        np.flatnonzero(cornerFound),
+    )
+
+
+def clipRoi(roi: tuple[int], imageShape: tuple[int]) -> tuple[int]:
+    """Clip a region of interest to the bounds of the image.
+
+    Args:
+        roi (tuple[int]): region (x0, y0, x1, y1), or None for the whole image.
+        imageShape (tuple[int]): shape of the image.
+
+    Returns:
+        tuple[int]: clipped region (x0, y0, x1, y1), with x0 <= x1 and y0 <= y1.
+        The region is empty if it lies outside of the image.
+    """
+    height, width = imageShape[:2]
+    if roi is None:
+        return 0, 0, width, height
+    x0, y0, x1, y1 = roi
+    x0 = min(max(int(x0), 0), width)
+    y0 = min(max(int(y0), 0), height)
+    return (
+        x0,
+        y0,
+        min(max(int(x1), x0), width),
+        min(max(int(y1), y0), height),
+    )
+
+
+def labelMarker(image: np.ndarray, detection: MarkerDetection) -> None:
+    """Mark the concave corner of a detected marker, and write its label on it.
+
+    Args:
+        image (np.ndarray): image to annotate.
+        detection (MarkerDetection): detected marker.
+    """
+    # ! Draw a red circle at the corner point.
+    cv.circle(
+        image,
+        (detection.px, detection.py),
+        radius=1,
+        color=(0, 0, 255),
+        thickness=6,
+    )
+    # Write the label on the marker in decimal representation.
+    cv.putText(
+        img=image,
+        text=str(detection.markerId),
+        org=(detection.px, detection.py),
+        fontScale=1.0,
+        fontFace=cv.FONT_HERSHEY_SIMPLEX,
+        color=(0, 0, 0),
+        thickness=9,
+    )
+    cv.putText(
+        img=image,
+        text=str(detection.markerId),
+        org=(detection.px, detection.py),
+        fontScale=1.0,
+        fontFace=cv.FONT_HERSHEY_SIMPLEX,
+        color=(255, 255, 255),
+        thickness=3,
+    )
+
+
+def annotateFrame(
+    image: np.ndarray,
+    detections: list[MarkerDetection],
+    polygons: list[np.ndarray] = None,
+    samplePoints: list[np.ndarray] = None,
+) -> None:
+    """Draw the detected markers on the image: the candidate polygons, the points
+    sampled along their axes, their concave corners and their labels. Only the
+    detections are required, so the annotation can be replayed from stored
+    results, without the polygons and the sampled points.
+
+    Args:
+        image (np.ndarray): image to annotate.
+        detections (list[MarkerDetection]): markers detected in the image.
+        polygons (list[np.ndarray], optional): polygons to outline, identified or
+        not. Defaults to None.
+        samplePoints (list[np.ndarray], optional): (K, 2) points sampled along the
+        axis of each marker. Defaults to None.
+    """
+    if polygons is not None:
+        # ! Draw the polygons found on the original image with a green line
+        # ! of width 2 pixels.
+        cv.polylines(image, polygons, True, (0, 255, 0), 2)
+    for markerIndex, detection in enumerate(detections):
+        if samplePoints is not None:
+            # Draw the center of each sampled circle.
+            for samplePoint in samplePoints[markerIndex]:
                 cv.circle(
                     image,
                     (
-                        concaveCornerPoint[0],
-                        concaveCornerPoint[1],
+                        int(samplePoint[0]),
+                        int(samplePoint[1]),
                     ),
                     radius=1,
-                    color=(0, 0, 255),
-                    thickness=6,
+                    color=(255, 0, 0),
+                    thickness=2,
                 )
+        labelMarker(image, detection)
 
-                # "A" was found, so I use it to generate a line between it and
-                # the middle point on the lower side of the marker: I use this
-                # line to look in the 5 areas where each circle should reside,
-                # obtaining in such way the binary value of each marker.
-                # ! Calculate the midpoint of the side opposite the concave corner
-                # ! and store it in lowerSideMiddlePoint.
-                lowerSide = (
-                    poly[matchingSides[(loopIndex + 2) % 3]][0],
-                    poly[(matchingSides[(loopIndex + 2) % 3] + 1) % totalVertices][0],
-                )
-                middlePointX = (lowerSide[0][0] + lowerSide[1][0]) // 2
-                middlePointY = (lowerSide[0][1] + lowerSide[1][1]) // 2
-                lowerSideMiddlePoint = (middlePointX, middlePointY)
-
-                # Use the found middle point and "A" to generate the line
-                # between them.
-                markerAxis = bresenhamLineGenerator(
-                    concaveCornerPoint[0],
-                    concaveCornerPoint[1],
-                    lowerSideMiddlePoint[0],
-                    lowerSideMiddlePoint[1],
+
+class MarkerDetector:
+    """Detector of the markers in the frames of a video.
+
+    It is created once per video resolution, and owns the buffers of the
+    grayscale and thresholded region of interest, which are filled in place
+    frame after frame, so the detection doesn't allocate any image. The
+    real-world coordinates of the markers are looked up from
+    MARKER_WORLD_COORDINATES. Each stage of the detection is exposed as a method,
+    so it can be run on its own.
+
+    A detector must not be shared by concurrent threads, since its buffers are
+    overwritten by every detection.
+    """
+
+    def __init__(
+        self,
+        frameShape: tuple[int],
+        threshold: int = 190,
+        minArea: float = 1200,
+        approxEpsilon: float = 0.0155,
+        shortSide: float = 80,
+        blackLevel: int = 180,
+        firstCorrection: float = 0.9,
+        correction: float = 0.85,
+        pyramidScale: float = None,
+    ) -> None:
+        """Allocate the buffers for frames of the given shape.
+
+        Args:
+            frameShape (tuple[int]): shape of the frames of the video.
+            threshold (int, optional): gray level above which a pixel belongs to a
+            marker. Defaults to 190.
+            minArea (float, optional): minimum area of the contour of a marker.
+            Defaults to 1200.
+            approxEpsilon (float, optional): maximum distance between a contour and
+            its approximating polygon, as a fraction of the contour perimeter.
+            Defaults to 0.0155.
+            shortSide (float, optional): length below which a side of a polygon is
+            short. Defaults to 80.
+            blackLevel (int, optional): gray level up to which a sample of the axis
+            is black. Defaults to 180.
+            firstCorrection (float, optional): perspective correction of the first
+            sample of the axis. Defaults to 0.9.
+            correction (float, optional): perspective correction of the samples of
+            the axis from the second to the fifth. Defaults to 0.85.
+            pyramidScale (float, optional): if given, the pentagons are searched in
+            the binary region downscaled by this factor, such as 0.5, and their
+            vertices are refined on the full-resolution grayscale region through
+            cv.cornerSubPix (see findPolygonsCoarseToFine). Defaults to None, which
+            searches the pentagons at full resolution.
+        """
+        self.frameShape = tuple(frameShape[:2])
+        self.threshold = threshold
+        self.minArea = minArea
+        self.approxEpsilon = approxEpsilon
+        self.shortSide = shortSide
+        self.blackLevel = blackLevel
+        self.firstCorrection = firstCorrection
+        self.correction = correction
+        self.pyramidScale = pyramidScale
+        # The region of interest can change from frame to frame, so the buffers
+        # are large enough for the whole frame, and reshaped to the region.
+        self._grayBuffer = np.empty(frameShape[0] * frameShape[1], dtype=np.uint8)
+        self._threshBuffer = np.empty_like(self._grayBuffer)
+        self._coarseBuffer = None
+        if pyramidScale is not None:
+            if not 0 < pyramidScale < 1:
+                raise ValueError(
+                    f"The pyramid scale must be in (0, 1), not {pyramidScale}."
                 )
-                # ! FIXME: DA SPIEGARE!!
-                markerAxisLen = len(markerAxis)
-                actCycle = 0
-                cycleJump = int(markerAxisLen / 10 * 1.95)
-                binaryRepr = ""
-                for intervalCentreIndex in range(cycleJump, markerAxisLen, cycleJump):
-                    tempIndex = intervalCentreIndex
-
-                    # This if-elif block performs a little correction on the
-                    # place where to look for the white circles: theoretically,
-                    # the line generated through bresenham should be splitted into
-                    # 5 pieces, and the detection of each circle should be made by
-                    # looking into the centers of such pieces, but the line is
-                    # perspectively warped, so an adjustment is required when
-                    # looking for each circle's center.
-                    if actCycle in [1, 2, 3, 4]:
-                        tempIndex = int(tempIndex * 0.85)
-                    elif actCycle == 0:
-                        tempIndex = int(tempIndex * 0.9)
-                    actCycle += 1
-
-                    # Store the current slot status: white or black.
-                    # (180 seems a good threshold to discriminate them
-                    # according to some prints).
-                    binaryRepr += (
-                        "0"
-                        if gray[
-                            markerAxis[tempIndex][1],
-                            markerAxis[tempIndex][0],
-                        ]
-                        > 180
-                        else "1"
-                    )
-                    # Draw the center of the actual circle.
-                    cv.circle(
-                        image,
-                        (
-                            markerAxis[tempIndex][0],
-                            markerAxis[tempIndex][1],
-                        ),
-                        radius=1,
-                        color=(255, 0, 0),
-                        thickness=2,
-                    )
-                # Reverse the binary representation, which was captured backward,
-                # and write it on the marker in decimal representation.
-                # Also, using the computed label, access the related 3D coords.
-                binaryRepr = int(binaryRepr[::-1], 2)
-                binaryReprStr = str(binaryRepr)
-
-                # ! radians convert angle x from degrees to radians.
-                # ! FIXME: Why is it "-15"?
-                radAngle = radians(-15)
-                qx = cos(radAngle * binaryRepr) * 70
-                qy = sin(radAngle * binaryRepr) * 70
-                outputFileContent = (
-                    outputFileContent
-                    + f"{currentFrame},{binaryReprStr},{markerAxis[0][0]},{markerAxis[0][1]},{qx},{qy},0\n"
-                )  # ! The values includes the current frame number, a binary representation, the x and y coordinates of a marker axis,
-                # ! and the calculated values of qx, qy, and 0 are then concatenated and stored in outputFileContent.
-                image = cv.putText(
-                    img=image,
-                    text=binaryReprStr,
-                    org=(markerAxis[0][0], markerAxis[0][1]),
-                    fontScale=1.0,
-                    fontFace=cv.FONT_HERSHEY_SIMPLEX,
-                    color=(0, 0, 0),
-                    thickness=9,
+            self._coarseBuffer = np.empty(
+                (int(frameShape[0] * pyramidScale) + 1)
+                * (int(frameShape[1] * pyramidScale) + 1),
+                dtype=np.uint8,
+            )
+
+    def binarize(
+        self, image: np.ndarray, roi: tuple[int], profiler=NULL_PROFILER
+    ) -> tuple:
+        """Convert the region of interest of the image to grayscale and threshold
+        it, in the buffers of the detector.
+
+        Args:
+            image (np.ndarray): input image.
+            roi (tuple[int]): region (x0, y0, x1, y1), or None for the whole image.
+            profiler (optional): stage_profiler.StageProfiler recording the time
+            spent in each stage. Defaults to NULL_PROFILER, which records nothing.
+
+        Returns:
+            tuple: grayscale and binary regions of interest, which are overwritten
+            by the next call, and the full-frame coordinates of their top-left pixel.
+
+        Raises:
+            ValueError: if the image doesn't have the shape of the frames.
+        """
+        if image.shape[:2] != self.frameShape:
+            raise ValueError(
+                f"The detector handles {self.frameShape} frames, not {image.shape[:2]}."
+            )
+        # ! Convert the region of interest of the input image to grayscale: the
+        # ! rest of the image is never processed.
+        stageStart = profiler.now()
+        roiX0, roiY0, roiX1, roiY1 = clipRoi(roi, image.shape)
+        roiShape = (roiY1 - roiY0, roiX1 - roiX0)
+        gray = self._grayBuffer[: roiShape[0] * roiShape[1]].reshape(roiShape)
+        thresh = self._threshBuffer[: roiShape[0] * roiShape[1]].reshape(roiShape)
+        cv.cvtColor(image[roiY0:roiY1, roiX0:roiX1], cv.COLOR_BGR2GRAY, dst=gray)
+        stageStart = profiler.record("cvtColor", stageStart)
+
+        # 190 detects markers pretty well, but still requires an
+        # area control for small fake-markers appearing on the plastic
+        # cup.
+        cv.threshold(gray, self.threshold, 255, cv.THRESH_BINARY, dst=thresh)
+        profiler.record("threshold", stageStart)
+        return gray, thresh, (roiX0, roiY0)
+
+    def findContours(self, thresh: np.ndarray, origin: tuple[int]) -> tuple:
+        """Find the contours of the white regions of the binary image.
+
+        Args:
+            thresh (np.ndarray): binary region of interest.
+            origin (tuple[int]): full-frame coordinates of its top-left pixel.
+
+        Returns:
+            tuple: contours, in full-frame coordinates.
+        """
+        # I use CHAIN_APPROX_SIMPLE because it removes all redundant points
+        # and compresses the contour, thereby saving memory.
+        # ! Find the contours (i.e., the boundaries) of the white objects in the
+        # ! binary image using a hierarchical contour retrieval mode (RETR_TREE)
+        # ! and compress the contours by removing redundant points to save
+        # ! memory.
+        # ! The offset maps the contours back to full-frame coordinates.
+        contours, _ = cv.findContours(
+            thresh, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE, offset=origin
+        )
+        return contours
+
+    def filterPolygons(self, contours: tuple) -> list[np.ndarray]:
+        """Approximate the contours with polygons, keeping the large pentagons.
+
+        Args:
+            contours (tuple): contours found in the frame.
+
+        Returns:
+            list[np.ndarray]: (5, 1, 2) polygons which may be markers.
+        """
+        # Searching through every region selected to find the required polygon.
+        # ! Find the polygons with 5 vertices (pentagons) among the contours
+        # ! with area greater than 1200. The threshold of 1200 is used to
+        # ! filter out small fake-markers appearing on the plastic cup.
+        return [
+            approx
+            for cnt in contours
+            if cv.contourArea(cnt) > self.minArea
+            and len(
+                approx := cv.approxPolyDP(
+                    cnt, self.approxEpsilon * cv.arcLength(cnt, True), True
                 )
-                image = cv.putText(
-                    img=image,
-                    text=binaryReprStr,
-                    org=(markerAxis[0][0], markerAxis[0][1]),
-                    fontScale=1.0,
-                    fontFace=cv.FONT_HERSHEY_SIMPLEX,
-                    color=(255, 255, 255),
-                    thickness=3,
+            )
+            == 5
+        ]
+
+    def findPolygonsCoarseToFine(
+        self,
+        gray: np.ndarray,
+        thresh: np.ndarray,
+        origin: tuple[int],
+        profiler=NULL_PROFILER,
+    ) -> list[np.ndarray]:
+        """Find the pentagons in the binary region downscaled by pyramidScale, and
+        refine their vertices on the full-resolution grayscale region.
+
+        The contours are extracted and approximated on the coarse image, which has
+        pyramidScale ** 2 of its pixels, and the vertices of the pentagons are
+        then moved by cv.cornerSubPix to the nearest corner of the grayscale
+        region, within a window as large as a coarse pixel.
+
+        Args:
+            gray (np.ndarray): grayscale region of interest.
+            thresh (np.ndarray): binary region of interest.
+            origin (tuple[int]): full-frame coordinates of their top-left pixel.
+            profiler (optional): stage_profiler.StageProfiler recording the time
+            spent in each stage. Defaults to NULL_PROFILER, which records nothing.
+
+        Returns:
+            list[np.ndarray]: (5, 1, 2) polygons which may be markers, in full-frame
+            coordinates.
+        """
+        scale = self.pyramidScale
+        stageStart = profiler.now()
+        coarseShape = (
+            max(int(thresh.shape[0] * scale), 1),
+            max(int(thresh.shape[1] * scale), 1),
+        )
+        coarse = self._coarseBuffer[: coarseShape[0] * coarseShape[1]].reshape(
+            coarseShape
+        )
+        # ! INTER_AREA averages the pixels of each coarse pixel: thresholding the
+        # ! result again keeps the ones which are mostly white.
+        cv.resize(
+            thresh, coarseShape[::-1], dst=coarse, interpolation=cv.INTER_AREA
+        )
+        cv.threshold(coarse, 127, 255, cv.THRESH_BINARY, dst=coarse)
+        contours, _ = cv.findContours(coarse, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE)
+        stageStart = profiler.record("findContours", stageStart)
+        profiler.count("contours", len(contours))
+        polygons = [
+            approx
+            for cnt in contours
+            if cv.contourArea(cnt) > self.minArea * scale * scale
+            and len(
+                approx := cv.approxPolyDP(
+                    cnt, self.approxEpsilon * cv.arcLength(cnt, True), True
                 )
-                break
+            )
+            == 5
+        ]
+        stageStart = profiler.record("polygonFilter", stageStart)
+        if not polygons:
+            return []
+
+        # ! Map the vertices to the centres of their coarse pixels, in the
+        # ! full-resolution region, and refine them there.
+        corners = (np.concatenate(polygons).astype(np.float32) + 0.5) / scale - 0.5
+        np.clip(corners[..., 0], 0, gray.shape[1] - 1, out=corners[..., 0])
+        np.clip(corners[..., 1], 0, gray.shape[0] - 1, out=corners[..., 1])
+        halfWindow = max(int(np.ceil(1 / scale)), 2)
+        cv.cornerSubPix(
+            gray,
+            corners,
+            (halfWindow, halfWindow),
+            (-1, -1),
+            (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_COUNT, 20, 0.05),
+        )
+        corners += np.asarray(origin, dtype=np.float32)
+        profiler.record("cornerRefinement", stageStart)
+        return list(np.rint(corners).astype(np.int32).reshape(-1, 5, 1, 2))
+
+    def decodeMarkers(
+        self,
+        gray: np.ndarray,
+        origin: tuple[int],
+        polygons: list[np.ndarray],
+        currentFrame: int,
+        profiler=NULL_PROFILER,
+    ) -> tuple[list]:
+        """Find the concave corner and the axis of each polygon, and decode the
+        label of the markers by sampling their axes.
+
+        Args:
+            gray (np.ndarray): grayscale region of interest.
+            origin (tuple[int]): full-frame coordinates of its top-left pixel.
+            polygons (list[np.ndarray]): (5, 1, 2) polygons which may be markers.
+            currentFrame (int): index of the current image.
+            profiler (optional): stage_profiler.StageProfiler recording the time
+            spent in each stage. Defaults to NULL_PROFILER, which records nothing.
+
+        Returns:
+            tuple[list]: decoded markers, the (5, 2) polygon of each of them, and
+            the (K, 2) points sampled along the axis of each of them.
+        """
+        # ! Initialize empty lists to hold the detected markers, their polygons and
+        # ! the points sampled along their axes.
+        detections = []
+        markerPolygons = []
+        markerSamplePoints = []
+
+        # Find, for every marker, the point A and the middle point of the
+        # lower side.
+        stageStart = profiler.now()
+        concaveCornerPoints, lowerSideMiddlePoints, polygonIndices = findConcaveCorners(
+            polygons, self.shortSide
+        )
+        stageStart = profiler.record("cornerSearch", stageStart)
+
+        # Sample the axes of all the markers of the frame at once.
+        markerIds, samplePoints, validSamples = sampleMarkerAxes(
+            gray,
+            concaveCornerPoints,
+            lowerSideMiddlePoints,
+            origin,
+            self.blackLevel,
+            self.firstCorrection,
+            self.correction,
+        )
+        stageStart = profiler.record("axisSampling", stageStart)
+
+        for (
+            concaveCornerPoint,
+            polygonIndex,
+            markerId,
+            markerSamples,
+            markerValidSamples,
+        ) in zip(
+            concaveCornerPoints, polygonIndices, markerIds, samplePoints, validSamples
+        ):
+            # Markers whose axis is too short to be sampled can't be identified.
+            if not markerValidSamples.any():
+                continue
+            # Using the computed label, access the related 3D coords.
+            binaryRepr = int(markerId)
+            qx, qy, qz = (
+                MARKER_WORLD_COORDINATES[binaryRepr]
+                if binaryRepr < len(MARKER_WORLD_COORDINATES)
+                else markerWorldCoordinates(binaryRepr)
+            )
+            detection = MarkerDetection(
+                currentFrame,
+                binaryRepr,
+                int(concaveCornerPoint[0]),
+                int(concaveCornerPoint[1]),
+                qx,
+                qy,
+                qz,
+            )  # ! The values includes the current frame number, the marker label, the x and y coordinates of a marker axis,
+            # ! and the calculated values of qx, qy, and 0.
+            detections.append(detection)
+            markerPolygons.append(polygons[polygonIndex].reshape(5, 2))
+            markerSamplePoints.append(markerSamples[markerValidSamples])
+
+        profiler.record("labelling", stageStart)
+        return detections, markerPolygons, markerSamplePoints
+
+    def detectWithPolygons(
+        self,
+        image: np.ndarray,
+        currentFrame: int,
+        roi: tuple[int] = MARKERS_ROI,
+        annotate: bool = True,
+        profiler=NULL_PROFILER,
+    ) -> tuple[list]:
+        """Detect the visible markers: see detectAndLabelMarkerPolygons.
+
+        Args:
+            image (np.ndarray): input image.
+            currentFrame (int): index of the current image.
+            roi (tuple[int], optional): region (x0, y0, x1, y1) where the markers
+            are searched, or None for the whole image. Defaults to MARKERS_ROI.
+            annotate (bool, optional): whether to draw the detected markers on the
+            image. Defaults to True.
+            profiler (optional): stage_profiler.StageProfiler recording the time
+            spent in each stage. Defaults to NULL_PROFILER, which records nothing.
 
-    # ! It is opening a file named "obj{objectToTrack}_marker.csv" in append mode ("a")
-    outputFile = open(f"obj{objectToTrack}_marker.csv", "a")
-    # ! Then I write the content of the variable outputFileContent using write().
-    outputFile.write(outputFileContent)
-    outputFile.close()
+        Returns:
+            tuple[list]: markers detected in the current frame, the (5, 2) polygon
+            of each of them, and the (K, 2) points sampled along the axis of each
+            of them.
+        """
+        # ! No marker can be found if the region of interest lies outside of the
+        # ! image, as MARKERS_ROI does on frames narrower than 1200 pixels.
+        roiX0, roiY0, roiX1, roiY1 = clipRoi(roi, image.shape)
+        if roiX0 == roiX1 or roiY0 == roiY1:
+            return [], [], []
+        gray, thresh, origin = self.binarize(image, roi, profiler)
+        if self.pyramidScale is not None:
+            polygons = self.findPolygonsCoarseToFine(gray, thresh, origin, profiler)
+        else:
+            stageStart = profiler.now()
+            contours = self.findContours(thresh, origin)
+            stageStart = profiler.record("findContours", stageStart)
+            profiler.count("contours", len(contours))
+            polygons = self.filterPolygons(contours)
+            profiler.record("polygonFilter", stageStart)
+        profiler.count("polygons", len(polygons))
+        detections, markerPolygons, markerSamplePoints = self.decodeMarkers(
+            gray, origin, polygons, currentFrame, profiler
+        )
+        profiler.count("markers", len(detections))
+
+        if annotate:
+            stageStart = profiler.now()
+            # Every pentagon found is outlined, even if it couldn't be identified.
+            annotateFrame(image, detections, polygons, markerSamplePoints)
+            profiler.record("annotation", stageStart)
+
+        return detections, markerPolygons, markerSamplePoints
+
+    def detect(
+        self,
+        image: np.ndarray,
+        currentFrame: int,
+        roi: tuple[int] = MARKERS_ROI,
+        annotate: bool = True,
+        profiler=NULL_PROFILER,
+    ) -> list[MarkerDetection]:
+        """Detect and label the visible markers: see detectWithPolygons.
+
+        Args:
+            image (np.ndarray): input image.
+            currentFrame (int): index of the current image.
+            roi (tuple[int], optional): region (x0, y0, x1, y1) where the markers
+            are searched, or None for the whole image. Defaults to MARKERS_ROI.
+            annotate (bool, optional): whether to draw the detected markers on the
+            image. Defaults to True.
+            profiler (optional): stage_profiler.StageProfiler recording the time
+            spent in each stage. Defaults to NULL_PROFILER, which records nothing.
+
+        Returns:
+            list[MarkerDetection]: markers detected in the current frame.
+        """
+        return self.detectWithPolygons(image, currentFrame, roi, annotate, profiler)[0]
+
+
+# Detectors used by the functions below, one per frame shape and per thread.
+_detectors = local()
+
+
+def getDetector(frameShape: tuple[int]) -> MarkerDetector:
+    """Detector with the default parameters for the given frame shape, shared by
+    the calls made from the current thread.
+
+    Args:
+        frameShape (tuple[int]): shape of the frames.
+
+    Returns:
+        MarkerDetector: detector reused across the frames of the same shape.
+    """
+    detectors = _detectors.__dict__.setdefault("byShape", {})
+    detector = detectors.get(frameShape[:2])
+    if detector is None:
+        detector = detectors[frameShape[:2]] = MarkerDetector(frameShape)
+    return detector
+
+
+def detectAndLabelMarkers(
+    image: np.ndarray,
+    currentFrame: int,
+    roi: tuple[int] = MARKERS_ROI,
+    annotate: bool = True,
+    profiler=NULL_PROFILER,
+) -> list[MarkerDetection]:
+    """Detect the visible markers and label them: see detectAndLabelMarkerPolygons.
+
+    Args:
+        image (np.ndarray): input image.
+        currentFrame (int): index of the current image with respect to the total number
+        of frames in the video.
+        roi (tuple[int], optional): region (x0, y0, x1, y1) where the markers are
+        searched, or None for the whole image. Defaults to MARKERS_ROI.
+        annotate (bool, optional): whether to draw the detected markers on the image.
+        Defaults to True.
+        profiler (optional): stage_profiler.StageProfiler recording the time spent
+        in each stage. Defaults to NULL_PROFILER, which records nothing.
+
+    Returns:
+        list[MarkerDetection]: markers detected in the current frame.
+    """
+    return detectAndLabelMarkerPolygons(image, currentFrame, roi, annotate, profiler)[0]
+
+
+def detectAndLabelMarkerPolygons(
+    image: np.ndarray,
+    currentFrame: int,
+    roi: tuple[int] = MARKERS_ROI,
+    annotate: bool = True,
+    profiler=NULL_PROFILER,
+) -> tuple[list]:
+    """Detect the visible markers through their contours and then determine for
+    each of them the line which crosses all the circles from the bottom of the marker
+    to the concave corner. Eventually this line is used to traverse the marker, looking
+    for the white circles in fixed positions.
+
+    The detection is run by the MarkerDetector of the current thread for the shape
+    of the image, so consecutive frames reuse the same buffers.
+
+    Args:
+        image (np.ndarray): input image.
+        currentFrame (int): index of the current image with respect to the total number
+        of frames in the video.
+        roi (tuple[int], optional): region (x0, y0, x1, y1) where the markers are
+        searched, or None for the whole image. The image is cropped to it before
+        thresholding and extracting the contours, while the coordinates of the
+        detections always refer to the full frame. Defaults to MARKERS_ROI.
+        annotate (bool, optional): whether to draw the detected markers on the image
+        through annotateFrame. If False, the image is only read to compute its
+        grayscale version. Defaults to True.
+        profiler (optional): stage_profiler.StageProfiler recording the time spent
+        in each stage, and the number of contours, polygons and decoded markers.
+        Defaults to NULL_PROFILER, which records nothing.
+
+    Returns:
+        tuple[list]: markers detected in the current frame, the (5, 2) polygon of
+        each of them, and the (K, 2) points sampled along the axis of each of them.
+    """
+    return getDetector(image.shape).detectWithPolygons(
+        image, currentFrame, roi, annotate, profiler
+    )
@@ -0,0 +1,177 @@
+import cv2 as cv
+import numpy as np
+import marker_detector as mkdtct
+from marker_detector import MarkerDetection
+from stage_profiler import NULL_PROFILER
+
+
+class MarkerTracker:
+    """Detector following the markers from frame to frame instead of detecting
+    them again on every frame.
+
+    The turn-table moves the markers only a few pixels between consecutive
+    frames, so after a full detection the vertices of every marker polygon are
+    tracked through the pyramidal Lucas-Kanade optical flow, and the identity
+    of each marker is kept from the frame where it was decoded. A full
+    detection is performed every keyframeInterval frames, and whenever the
+    tracking confidence drops, that is when any vertex can't be tracked or the
+    forward-backward error of its flow exceeds maxTrackingError pixels.
+    """
+
+    def __init__(
+        self,
+        roi: tuple[int] = mkdtct.MARKERS_ROI,
+        keyframeInterval: int = 15,
+        maxTrackingError: float = 1.0,
+        windowSize: int = 21,
+        pyramidLevels: int = 0,
+    ) -> None:
+        """Initialize the tracker, with no markers tracked yet.
+
+        Args:
+            roi (tuple[int], optional): region (x0, y0, x1, y1) where the markers
+            are detected and tracked, or None for the whole image. Defaults to
+            MARKERS_ROI.
+            keyframeInterval (int, optional): maximum number of frames between two
+            full detections. Defaults to 15.
+            maxTrackingError (float, optional): maximum forward-backward error, in
+            pixels, of a tracked vertex. Defaults to 1.0.
+            windowSize (int, optional): side of the search window of the optical
+            flow at each pyramid level. Defaults to 21.
+            pyramidLevels (int, optional): number of pyramid levels of the optical
+            flow: the markers move only a few pixels per frame, so by default the
+            flow is computed at full resolution only. Defaults to 0.
+        """
+        self.roi = roi
+        self.keyframeInterval = keyframeInterval
+        self.maxTrackingError = maxTrackingError
+        self._margin = 2 * windowSize * 2**pyramidLevels
+        self.flowParams = dict(
+            winSize=(windowSize, windowSize),
+            maxLevel=pyramidLevels,
+            criteria=(cv.TERM_CRITERIA_EPS | cv.TERM_CRITERIA_COUNT, 20, 0.03),
+        )
+        # Detections tracked from the previous frame, with the (N, 5, 2) vertices
+        # of their polygons and the index of the concave corner among them.
+        self._detections = []
+        self._vertices = None
+        self._cornerIndices = None
+        self._previousGray = None
+        self._framesSinceKeyframe = 0
+
+    def _track(self, gray: np.ndarray, origin: tuple[int]) -> np.ndarray:
+        """Track the vertices of the markers from the previous frame.
+
+        Args:
+            gray (np.ndarray): grayscale region of interest of the current frame.
+            origin (tuple[int]): full-frame coordinates of the top-left pixel of gray.
+
+        Returns:
+            np.ndarray: (N, 5, 2) tracked vertices, or None if the tracking
+            confidence dropped.
+        """
+        # The flow is computed only around the markers: the pyramids are built
+        # over their bounding box, enlarged enough to contain the search windows.
+        previousPoints = self._vertices.reshape(-1, 1, 2) - origin
+        x0, y0 = np.maximum(previousPoints.min(axis=(0, 1)) - self._margin, 0)
+        x1, y1 = previousPoints.max(axis=(0, 1)) + self._margin
+        x0, y0, x1, y1 = int(x0), int(y0), int(x1), int(y1)
+        previousGray = self._previousGray[y0:y1, x0:x1]
+        currentGray = gray[y0:y1, x0:x1]
+        previousPoints = (previousPoints - (x0, y0)).astype(np.float32)
+
+        points, status, _ = cv.calcOpticalFlowPyrLK(
+            previousGray, currentGray, previousPoints, None, **self.flowParams
+        )
+        backPoints, backStatus, _ = cv.calcOpticalFlowPyrLK(
+            currentGray, previousGray, points, None, **self.flowParams
+        )
+        forwardBackwardError = np.linalg.norm(
+            (backPoints - previousPoints).reshape(-1, 2), axis=1
+        )
+        reliable = (
+            (status.ravel() == 1)
+            & (backStatus.ravel() == 1)
+            & (forwardBackwardError <= self.maxTrackingError)
+        )
+        if not reliable.all():
+            return None
+        return points.reshape(-1, 5, 2) + origin + (x0, y0)
+
+    def detect(
+        self,
+        image: np.ndarray,
+        currentFrame: int,
+        annotate: bool = True,
+        profiler=NULL_PROFILER,
+    ) -> list[MarkerDetection]:
+        """Detect and label the markers of the frame, tracking them from the
+        previous frame when possible.
+
+        Args:
+            image (np.ndarray): input image.
+            currentFrame (int): index of the current image.
+            annotate (bool, optional): whether to draw the markers on the image.
+            Defaults to True.
+            profiler (optional): stage_profiler.StageProfiler recording the time
+            spent in each stage. Defaults to NULL_PROFILER, which records nothing.
+
+        Returns:
+            list[MarkerDetection]: markers found in the current frame.
+        """
+        stageStart = profiler.now()
+        roiX0, roiY0, roiX1, roiY1 = mkdtct.clipRoi(self.roi, image.shape)
+        if roiX0 == roiX1 or roiY0 == roiY1:
+            # The region of interest lies outside of the image.
+            self._detections = []
+            self._previousGray = None
+            return self._detections
+        origin = np.array((roiX0, roiY0), dtype=np.float32)
+        gray = cv.cvtColor(image[roiY0:roiY1, roiX0:roiX1], cv.COLOR_BGR2GRAY)
+
+        trackedVertices = None
+        if (
+            self._detections
+            and self._previousGray is not None
+            and self._previousGray.shape == gray.shape
+            and self._framesSinceKeyframe + 1 < self.keyframeInterval
+        ):
+            trackedVertices = self._track(gray, origin)
+            stageStart = profiler.record("tracking", stageStart)
+        self._previousGray = gray
+
+        if trackedVertices is None:
+            self._framesSinceKeyframe = 0
+            detections, polygons, _ = mkdtct.detectAndLabelMarkerPolygons(
+                image, currentFrame, self.roi, annotate, profiler
+            )
+            self._detections = detections
+            if detections:
+                self._vertices = np.array(polygons, dtype=np.float32)
+                self._cornerIndices = np.array(
+                    [
+                        np.flatnonzero(
+                            (polygon == (detection.px, detection.py)).all(axis=1)
+                        )[0]
+                        for detection, polygon in zip(detections, polygons)
+                    ]
+                )
+            return detections
+
+        self._framesSinceKeyframe += 1
+        self._vertices = trackedVertices
+        corners = np.rint(
+            trackedVertices[np.arange(len(trackedVertices)), self._cornerIndices]
+        ).astype(int)
+        self._detections = [
+            detection._replace(frame=currentFrame, px=int(px), py=int(py))
+            for detection, (px, py) in zip(self._detections, corners)
+        ]
+        profiler.count("markers", len(self._detections))
+
+        if annotate:
+            mkdtct.annotateFrame(
+                image, self._detections, list(np.rint(trackedVertices).astype(np.int32))
+            )
+            profiler.record("annotation", stageStart)
+        return self._detections
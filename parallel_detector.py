@@ -0,0 +1,168 @@
+from collections import deque
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+import cv2 as cv
+import numpy as np
+import marker_detector as mkdtct
+from frame_reader import captureFrameShape, readInto
+from stage_profiler import StageProfiler, NULL_PROFILER
+
+# View over the shared ring of frame slots, attached once by every worker.
+_workerMemory = None
+_workerFrames = None
+
+
+def _initWorker(memoryName: str, slotsCount: int, frameShape: tuple) -> None:
+    """Attach the worker process to the shared ring of frame slots.
+
+    Args:
+        memoryName (str): name of the shared memory block hosting the slots.
+        slotsCount (int): number of frame slots in the ring.
+        frameShape (tuple): shape of each frame.
+    """
+    global _workerMemory, _workerFrames
+    # Every worker handles one frame at a time: letting OpenCV spawn its own
+    # threads in each of them would only oversubscribe the cores.
+    cv.setNumThreads(1)
+    _workerMemory = SharedMemory(name=memoryName)
+    _workerFrames = np.ndarray(
+        (slotsCount, *frameShape), dtype=np.uint8, buffer=_workerMemory.buf
+    )
+
+
+def _detectChunk(chunk: list, roi: tuple[int], annotate: bool, profile: bool):
+    """Detect and label the markers of a chunk of frames, annotating them in
+    place in their shared slots.
+
+    Args:
+        chunk (list[tuple[int]]): (slot, frame index) couples to process.
+        roi (tuple[int]): region (x0, y0, x1, y1) where the markers are searched.
+        annotate (bool): whether to draw the markers on the frames.
+        profile (bool): whether to measure the stages of the detection.
+
+    Returns:
+        tuple: detections of each frame of the chunk, in the same order, and the
+        StageProfiler holding the measures of the chunk, or None if not profiling.
+    """
+    profiler = StageProfiler() if profile else NULL_PROFILER
+    chunkDetections = []
+    for slot, index in chunk:
+        stageStart = profiler.now()
+        chunkDetections.append(
+            mkdtct.detectAndLabelMarkers(
+                image=_workerFrames[slot],
+                currentFrame=index,
+                roi=roi,
+                annotate=annotate,
+                profiler=profiler,
+            )
+        )
+        profiler.record("detect", stageStart)
+    return chunkDetections, profiler if profile else None
+
+
+def detectInParallel(
+    vidcap: cv.VideoCapture,
+    framesCount: int,
+    videoWriter: cv.VideoWriter,
+    sink,
+    workers: int,
+    chunkSize: int = 4,
+    roi: tuple[int] = mkdtct.MARKERS_ROI,
+    profiler=NULL_PROFILER,
+    startFrame: int = 0,
+) -> None:
+    """Detect and label the markers of the video using a pool of worker processes.
+
+    The frames are decoded straight into a ring of slots living in shared memory,
+    so the workers read and annotate them in place, and only the slot indices and
+    the detections travel between the processes. The chunks are reassembled in frame
+    order, so both the detections and the annotated frames are written in the same
+    order as the sequential detection would produce.
+
+    Args:
+        vidcap (cv.VideoCapture): opened input video.
+        framesCount (int): number of frames to process.
+        videoWriter (cv.VideoWriter): writer of the annotated video, or None to
+        skip both the annotation and the encoding.
+        sink: result sink receiving the detections of every frame.
+        workers (int): number of worker processes.
+        chunkSize (int, optional): number of consecutive frames sent to a worker
+        at once. Defaults to 4.
+        roi (tuple[int], optional): region (x0, y0, x1, y1) where the markers are
+        searched. Defaults to MARKERS_ROI.
+        profiler (optional): stage_profiler.StageProfiler recording the time spent
+        in each stage. The workers measure every chunk with their own profiler,
+        which is merged into this one. Defaults to NULL_PROFILER, which records
+        nothing.
+        startFrame (int, optional): index of the first frame to process, where the
+        video is positioned. Defaults to 0.
+    """
+    profile = profiler is not NULL_PROFILER
+    frameShape = captureFrameShape(vidcap)
+    # Two chunks per worker: one being processed and one ready to be picked up.
+    chunksCount = 2 * workers
+    slotsCount = chunksCount * chunkSize
+    memory = SharedMemory(create=True, size=slotsCount * int(np.prod(frameShape)))
+    frames = np.ndarray((slotsCount, *frameShape), dtype=np.uint8, buffer=memory.buf)
+
+    try:
+        with get_context("spawn").Pool(
+            workers,
+            initializer=_initWorker,
+            initargs=(memory.name, slotsCount, frameShape),
+        ) as pool:
+            freeChunks = deque(range(chunksCount))
+            pendingChunks = deque()
+            nextIndex = startFrame
+            exhausted = False
+            while not exhausted or pendingChunks:
+                # Keep every free group of slots busy while frames are left.
+                while not exhausted and freeChunks:
+                    group = freeChunks.popleft()
+                    chunk = []
+                    for slot in range(group * chunkSize, (group + 1) * chunkSize):
+                        if nextIndex >= framesCount:
+                            break
+                        stageStart = profiler.now()
+                        if not readInto(vidcap, frames[slot]):
+                            break
+                        profiler.record("decode", stageStart)
+                        chunk.append((slot, nextIndex))
+                        nextIndex += 1
+                    if len(chunk) < chunkSize:
+                        exhausted = True
+                    if not chunk:
+                        freeChunks.append(group)
+                        break
+                    pendingChunks.append(
+                        (
+                            group,
+                            chunk,
+                            pool.apply_async(
+                                _detectChunk,
+                                (chunk, roi, videoWriter is not None, profile),
+                            ),
+                        )
+                    )
+
+                # Write the oldest chunk, so the output keeps the frame order.
+                if pendingChunks:
+                    group, chunk, result = pendingChunks.popleft()
+                    stageStart = profiler.now()
+                    chunkDetections, chunkProfiler = result.get()
+                    stageStart = profiler.record("waitWorkers", stageStart)
+                    if chunkProfiler is not None:
+                        profiler.merge(chunkProfiler)
+                    for (slot, index), detections in zip(chunk, chunkDetections):
+                        stageStart = profiler.now()
+                        sink.write(index, detections)
+                        stageStart = profiler.record("sink", stageStart)
+                        if videoWriter is not None:
+                            videoWriter.write(frames[slot])
+                            profiler.record("encode", stageStart)
+                    freeChunks.append(group)
+    finally:
+        del frames
+        memory.close()
+        memory.unlink()
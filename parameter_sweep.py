@@ -0,0 +1,442 @@
+import argparse
+import json
+import math
+import sys
+from functools import partial
+from itertools import product
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+import cv2 as cv
+import numpy as np
+import marker_detector as mkdtct
+from frame_reader import captureFrameShape
+
+# Parameters of MarkerDetector which can be swept, with their default values.
+SWEEP_PARAMETERS = {
+    "threshold": 190,
+    "minArea": 1200,
+    "approxEpsilon": 0.0155,
+    "shortSide": 80,
+    "blackLevel": 180,
+    "firstCorrection": 0.9,
+    "correction": 0.85,
+}
+# Number of markers on the turn-table: any other label is a misreading.
+MARKERS_COUNT = 24
+
+# Grayscale frames shared by the main process, attached once by every worker.
+_workerMemory = None
+_workerGrays = None
+
+
+def decodeGrayFrames(
+    videoPath: str,
+    roi: tuple[int] = mkdtct.MARKERS_ROI,
+    maxFrames: int = 300,
+    step: int = 1,
+) -> tuple:
+    """Decode the video once, keeping the grayscale region of interest of its
+    frames, which is all that the detection reads.
+
+    Args:
+        videoPath (str): path of the video.
+        roi (tuple[int], optional): region (x0, y0, x1, y1) where the markers are
+        searched, or None for the whole frame. Defaults to MARKERS_ROI.
+        maxFrames (int, optional): maximum number of frames to keep. Defaults to
+        300.
+        step (int, optional): one frame every step is kept. Defaults to 1.
+
+    Returns:
+        tuple: (F, H, W) grayscale regions of interest, index of their frames,
+        full-frame coordinates of their top-left pixel, and shape of the frames.
+
+    Raises:
+        OSError: if the video can't be opened.
+        ValueError: if the region of interest lies outside of the frames.
+    """
+    vidcap = cv.VideoCapture(videoPath)
+    if not vidcap.isOpened():
+        raise OSError(f"Can't open the video {videoPath}.")
+    frameShape = captureFrameShape(vidcap)
+    roiX0, roiY0, roiX1, roiY1 = mkdtct.clipRoi(roi, frameShape)
+    if roiX0 == roiX1 or roiY0 == roiY1:
+        vidcap.release()
+        raise ValueError(
+            f"The region of interest {roi} lies outside of the {frameShape[:2]} "
+            f"frames of {videoPath}."
+        )
+    grays = []
+    frameIndices = []
+    origin = (0, 0)
+    try:
+        index = 0
+        while len(grays) < maxFrames:
+            # The skipped frames are only grabbed, without being decoded.
+            if index % step and vidcap.grab():
+                index += 1
+                continue
+            success, frame = vidcap.read()
+            if not success:
+                break
+            roiX0, roiY0, roiX1, roiY1 = mkdtct.clipRoi(roi, frame.shape)
+            origin = (roiX0, roiY0)
+            grays.append(
+                cv.cvtColor(frame[roiY0:roiY1, roiX0:roiX1], cv.COLOR_BGR2GRAY)
+            )
+            frameIndices.append(index)
+            index += 1
+    finally:
+        vidcap.release()
+    if not grays:
+        raise OSError(f"No frames could be decoded from {videoPath}.")
+    return np.stack(grays), frameIndices, origin, frameShape
+
+
+def parameterGrid(**values) -> list[dict]:
+    """Every combination of the given parameter values.
+
+    Args:
+        **values: list of values of each parameter of SWEEP_PARAMETERS. The
+        parameters not given keep their default value.
+
+    Returns:
+        list[dict]: parameter sets.
+    """
+    unknown = set(values) - set(SWEEP_PARAMETERS)
+    if unknown:
+        raise ValueError(f"Unknown parameters: {sorted(unknown)}.")
+    names = list(SWEEP_PARAMETERS)
+    axes = [values.get(name) or [SWEEP_PARAMETERS[name]] for name in names]
+    return [dict(zip(names, combination)) for combination in product(*axes)]
+
+
+def idStability(
+    detectionsByFrame: list[list[mkdtct.MarkerDetection]], maxMotion: float
+) -> float:
+    """Fraction of the markers keeping their label from a frame to the next one.
+
+    Every marker is matched with the nearest marker of the previous frame, if
+    their concave corners are closer than maxMotion pixels.
+
+    Args:
+        detectionsByFrame (list[list[MarkerDetection]]): detections of consecutive
+        frames.
+        maxMotion (float): maximum motion, in pixels, of a marker between two
+        frames.
+
+    Returns:
+        float: fraction of the matched markers with the same label, or 1.0 if no
+        marker could be matched.
+    """
+    matched = 0
+    stable = 0
+    for previous, current in zip(detectionsByFrame, detectionsByFrame[1:]):
+        if not previous or not current:
+            continue
+        previousCorners = np.array([(d.px, d.py) for d in previous])
+        currentCorners = np.array([(d.px, d.py) for d in current])
+        distances = np.linalg.norm(
+            currentCorners[:, None] - previousCorners[None], axis=2
+        )
+        nearest = distances.argmin(axis=1)
+        for detection, previousIndex, distance in zip(
+            current, nearest, distances[np.arange(len(current)), nearest]
+        ):
+            if distance <= maxMotion:
+                matched += 1
+                stable += detection.markerId == previous[previousIndex].markerId
+    return stable / matched if matched else 1.0
+
+
+def _initWorker(memoryName: str, graysShape: tuple) -> None:
+    """Attach the worker process to the shared grayscale frames.
+
+    Args:
+        memoryName (str): name of the shared memory block hosting the frames.
+        graysShape (tuple): shape of the (F, H, W) frames.
+    """
+    global _workerMemory, _workerGrays
+    cv.setNumThreads(1)
+    _workerMemory = SharedMemory(name=memoryName)
+    _workerGrays = np.ndarray(graysShape, dtype=np.uint8, buffer=_workerMemory.buf)
+
+
+def _evaluateLevel(
+    threshold: int,
+    parameterSets: list[dict],
+    frameShape: tuple,
+    origin: tuple,
+    maxMotion: float,
+) -> list[dict]:
+    """Evaluate parameter sets sharing a binarization level.
+
+    The frames are thresholded and their contours extracted once for all the
+    sets, and the polygons once for each distinct area and epsilon, so only the
+    decoding runs once per set. A set whose detection fails is reported with
+    its error, without stopping the other ones.
+
+    Args:
+        threshold (int): binarization level shared by the sets.
+        parameterSets (list[dict]): parameter sets to evaluate.
+        frameShape (tuple): shape of the frames of the video.
+        origin (tuple): full-frame coordinates of the top-left pixel of the
+        grayscale frames.
+        maxMotion (float): maximum motion, in pixels, of a marker between two of
+        the frames, used to measure the label stability.
+
+    Returns:
+        list[dict]: parameter set and either the metrics or the error of each set.
+    """
+    detectors = []
+    errors = [None] * len(parameterSets)
+    for setIndex, params in enumerate(parameterSets):
+        try:
+            detectors.append(mkdtct.MarkerDetector(frameShape, **params))
+        except Exception as error:
+            detectors.append(None)
+            errors[setIndex] = f"{type(error).__name__}: {error}"
+    detectionsBySet = [[] for _ in parameterSets]
+    for frameIndex, gray in enumerate(_workerGrays):
+        running = [
+            setIndex for setIndex, error in enumerate(errors) if error is None
+        ]
+        if not running:
+            break
+        _, thresh = cv.threshold(gray, threshold, 255, cv.THRESH_BINARY)
+        contours = detectors[running[0]].findContours(thresh, origin)
+        polygonsByFilter = {}
+        for setIndex in running:
+            detector = detectors[setIndex]
+            try:
+                polygonFilter = (detector.minArea, detector.approxEpsilon)
+                if polygonFilter not in polygonsByFilter:
+                    polygonsByFilter[polygonFilter] = detector.filterPolygons(
+                        contours
+                    )
+                detectionsBySet[setIndex].append(
+                    detector.decodeMarkers(
+                        gray, origin, polygonsByFilter[polygonFilter], frameIndex
+                    )[0]
+                )
+            except Exception as error:
+                errors[setIndex] = (
+                    f"{type(error).__name__}: {error} (frame {frameIndex})"
+                )
+
+    results = []
+    for params, detections, error in zip(parameterSets, detectionsBySet, errors):
+        if error is not None:
+            results.append({"parameters": params, "error": error})
+            continue
+        markers = [len(frameDetections) for frameDetections in detections]
+        labels = [d.markerId for frameDetections in detections for d in frameDetections]
+        results.append(
+            {
+                "parameters": params,
+                "markersPerFrame": float(np.mean(markers)),
+                "detectionRate": float(np.mean([count > 0 for count in markers])),
+                "validLabelRate": (
+                    float(np.mean([label < MARKERS_COUNT for label in labels]))
+                    if labels
+                    else 0.0
+                ),
+                "idStability": idStability(detections, maxMotion),
+            }
+        )
+    return results
+
+
+def splitTasks(levels: dict, workers: int) -> list[tuple]:
+    """Split the parameter sets of each binarization level into tasks, so that
+    all the workers are used even when few levels are swept.
+
+    Each level gets a share of the workers proportional to its number of sets,
+    rounded up, and its sets are dealt evenly among that many tasks. Every task thresholds
+    the frames and extracts their contours again, so a level is split no further
+    than needed.
+
+    Args:
+        levels (dict): indices of the parameter sets of each binarization level.
+        workers (int): number of worker processes.
+
+    Returns:
+        list[tuple]: binarization level and indices of the parameter sets of
+        each task.
+    """
+    totalSets = sum(len(setIndices) for setIndices in levels.values())
+    tasks = []
+    for level, setIndices in levels.items():
+        chunks = min(
+            len(setIndices), max(1, math.ceil(workers * len(setIndices) / totalSets))
+        )
+        tasks.extend((level, setIndices[chunk::chunks]) for chunk in range(chunks))
+    return tasks
+
+
+def runSweep(
+    videoPath: str,
+    parameterSets: list[dict],
+    workers: int = 4,
+    roi: tuple[int] = mkdtct.MARKERS_ROI,
+    maxFrames: int = 300,
+    step: int = 1,
+    maxMotion: float = 20,
+) -> list[dict]:
+    """Evaluate many parameter sets of the detector over a video, decoding it only
+    once.
+
+    The grayscale frames are kept in shared memory, and the sets are grouped by
+    binarization level: each group is split into as many tasks as its share of
+    the workers (see splitTasks), and each task thresholds the frames and
+    extracts their contours once for all its sets.
+
+    Args:
+        videoPath (str): path of the video.
+        parameterSets (list[dict]): keyword arguments of MarkerDetector of each set,
+        see parameterGrid.
+        workers (int, optional): number of worker processes. Defaults to 4.
+        roi (tuple[int], optional): region (x0, y0, x1, y1) where the markers are
+        searched, or None for the whole frame. Defaults to MARKERS_ROI.
+        maxFrames (int, optional): maximum number of frames evaluated. Defaults to
+        300.
+        step (int, optional): one frame every step is evaluated. Defaults to 1.
+        maxMotion (float, optional): maximum motion, in pixels, of a marker between
+        two consecutive frames. Defaults to 20.
+
+    Returns:
+        list[dict]: parameter set and metrics of each set, in the given order: mean
+        markers per frame, fraction of frames with markers, fraction of labels of
+        existing markers, and fraction of markers keeping their label across
+        frames. A set which failed has an "error" entry instead of the metrics.
+    """
+    grays, _, origin, frameShape = decodeGrayFrames(videoPath, roi, maxFrames, step)
+
+    levels = {}
+    for setIndex, params in enumerate(parameterSets):
+        level = params.get("threshold", SWEEP_PARAMETERS["threshold"])
+        levels.setdefault(level, []).append(setIndex)
+    tasks = splitTasks(levels, max(1, workers))
+
+    memory = SharedMemory(create=True, size=grays.nbytes)
+    try:
+        np.ndarray(grays.shape, dtype=np.uint8, buffer=memory.buf)[...] = grays
+        with get_context("spawn").Pool(
+            max(1, min(workers, len(tasks))),
+            initializer=_initWorker,
+            initargs=(memory.name, grays.shape),
+        ) as pool:
+            pending = [
+                (
+                    setIndices,
+                    pool.apply_async(
+                        _evaluateLevel,
+                        (
+                            level,
+                            [parameterSets[index] for index in setIndices],
+                            frameShape,
+                            origin,
+                            maxMotion * step,
+                        ),
+                    ),
+                )
+                for level, setIndices in tasks
+            ]
+            results = [None] * len(parameterSets)
+            for setIndices, result in pending:
+                try:
+                    setResults = result.get()
+                except Exception as error:
+                    setResults = [
+                        {
+                            "parameters": parameterSets[index],
+                            "error": f"{type(error).__name__}: {error}",
+                        }
+                        for index in setIndices
+                    ]
+                for index, setResult in zip(setIndices, setResults):
+                    results[index] = setResult
+    finally:
+        memory.close()
+        memory.unlink()
+    return results
+
+
+def _parseValues(text: str, kind: type) -> list:
+    return [kind(value) for value in text.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare parameter sets of the detector over a video."
+    )
+    parser.add_argument("video", help="video to evaluate")
+    parser.add_argument(
+        "--frames", type=int, default=300, help="maximum number of frames evaluated"
+    )
+    parser.add_argument(
+        "--step", type=int, default=1, help="evaluate one frame every step"
+    )
+    parser.add_argument(
+        "-j", "--workers", type=int, default=4, help="number of worker processes"
+    )
+    parser.add_argument(
+        "--max-motion",
+        type=float,
+        default=20,
+        help="pixels a marker can move between two consecutive frames",
+    )
+    parser.add_argument("--json", help="write the full report to this json file")
+    for name, default in SWEEP_PARAMETERS.items():
+        option = "--" + "".join("-" + c.lower() if c.isupper() else c for c in name)
+        parser.add_argument(
+            option,
+            dest=name,
+            type=partial(_parseValues, kind=type(default)),
+            help=f"comma-separated values (default {default})",
+        )
+    args = parser.parse_args()
+
+    parameterSets = parameterGrid(
+        **{name: getattr(args, name) for name in SWEEP_PARAMETERS}
+    )
+    print(f"Evaluating {len(parameterSets)} parameter sets.", file=sys.stderr)
+    results = runSweep(
+        args.video,
+        parameterSets,
+        args.workers,
+        maxFrames=args.frames,
+        step=args.step,
+        maxMotion=args.max_motion,
+    )
+
+    names = list(SWEEP_PARAMETERS)
+    failed = [result for result in results if "error" in result]
+    print("\t".join(names + ["markers/frame", "detected", "valid ids", "id stability"]))
+    for result in sorted(
+        [result for result in results if "error" not in result],
+        key=lambda result: (result["idStability"], result["markersPerFrame"]),
+        reverse=True,
+    ):
+        print(
+            "\t".join(
+                [str(result["parameters"][name]) for name in names]
+                + [
+                    f"{result['markersPerFrame']:.2f}",
+                    f"{result['detectionRate']:.3f}",
+                    f"{result['validLabelRate']:.3f}",
+                    f"{result['idStability']:.3f}",
+                ]
+            )
+        )
+    if args.json:
+        with open(args.json, "w") as reportFile:
+            json.dump(results, reportFile, indent=2)
+    for result in failed:
+        print(
+            "[failed] "
+            + ", ".join(f"{name}={result['parameters'][name]}" for name in names)
+            + f": {result['error']}",
+            file=sys.stderr,
+        )
+    if failed:
+        sys.exit(f"{len(failed)}/{len(results)} parameter sets failed.")
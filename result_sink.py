@@ -0,0 +1,143 @@
+from marker_detector import MarkerDetection
+
+# Header of the csv files produced by the detection.
+CSV_HEADER = "FRAME, MARK_ID,   Px,   Py,    X,    Y, Z\n"
+
+
+def formatCsvRow(detection: MarkerDetection) -> str:
+    """Format a detection as a row of the csv output.
+
+    Args:
+        detection (MarkerDetection): detected marker.
+
+    Returns:
+        str: csv row, newline included.
+    """
+    return (
+        f"{detection.frame},{detection.markerId},{detection.px},{detection.py},"
+        f"{detection.x},{detection.y},{detection.z:g}\n"
+    )
+
+
+def parseCsvRow(row: str) -> MarkerDetection:
+    """Parse a row of the csv output back into a detection.
+
+    Args:
+        row (str): csv row.
+
+    Returns:
+        MarkerDetection: detected marker.
+    """
+    frame, markerId, px, py, x, y, z = row.split(",")
+    return MarkerDetection(
+        int(frame), int(markerId), int(px), int(py), float(x), float(y), float(z)
+    )
+
+
+def readCsvResults(path: str) -> dict[int, list[MarkerDetection]]:
+    """Read the detections stored in a csv file, grouped by frame.
+
+    Args:
+        path (str): path of the csv file.
+
+    Returns:
+        dict[int, list[MarkerDetection]]: detections of each frame with markers.
+    """
+    detectionsByFrame = {}
+    with open(path) as csvFile:
+        next(csvFile)
+        for row in csvFile:
+            if row.strip():
+                detection = parseCsvRow(row)
+                detectionsByFrame.setdefault(detection.frame, []).append(detection)
+    return detectionsByFrame
+
+
+class CsvResultSink:
+    """Result sink writing the detections to a csv file.
+
+    The file is kept open for the whole run, and the rows are buffered in memory
+    and written at once every flushInterval frames, so the detection loop does
+    not pay a file operation per frame.
+
+    Any object exposing the same write(frame, detections), flush() and close()
+    methods can be used as a sink by detectMarkerAndTrack.
+    """
+
+    def __init__(
+        self, path: str, flushInterval: int = 100, resumeOffset: int = None
+    ) -> None:
+        """Open the csv file, truncating it, and write its header.
+
+        Args:
+            path (str): path of the csv file.
+            flushInterval (int, optional): number of frames buffered before the
+            rows are written to the file. Defaults to 100.
+            resumeOffset (int, optional): if given, the existing file is kept up to
+            this byte offset, dropping anything written after it, and the new rows
+            are appended to it. Defaults to None.
+        """
+        self.path = path
+        self.flushInterval = flushInterval
+        if resumeOffset is None:
+            self._file = open(path, "w")
+            self._file.write(CSV_HEADER)
+        else:
+            self._file = open(path, "r+")
+            self._file.truncate(resumeOffset)
+            self._file.seek(resumeOffset)
+        self._rows = []
+        self._bufferedFrames = 0
+
+    def write(self, frame: int, detections: list[MarkerDetection]) -> None:
+        """Buffer the detections of a frame, flushing them if the interval elapsed.
+
+        Args:
+            frame (int): index of the frame.
+            detections (list[MarkerDetection]): markers detected in the frame.
+        """
+        self._rows.extend(formatCsvRow(detection) for detection in detections)
+        self._bufferedFrames += 1
+        if self._bufferedFrames >= self.flushInterval:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the buffered rows to the file."""
+        self._file.write("".join(self._rows))
+        self._file.flush()
+        self._rows.clear()
+        self._bufferedFrames = 0
+
+    def close(self) -> None:
+        """Flush the buffered rows and close the file."""
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class MemoryResultSink:
+    """Result sink keeping the detections in memory, for in-process use."""
+
+    def __init__(self) -> None:
+        self.detections = []
+
+    def write(self, frame: int, detections: list[MarkerDetection]) -> None:
+        """Store the detections of a frame.
+
+        Args:
+            frame (int): index of the frame.
+            detections (list[MarkerDetection]): markers detected in the frame.
+        """
+        self.detections.extend(detections)
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
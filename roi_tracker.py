@@ -0,0 +1,122 @@
+import numpy as np
+import marker_detector as mkdtct
+from marker_detector import MarkerDetection
+from stage_profiler import NULL_PROFILER
+
+
+def intersectRois(first: tuple[int], second: tuple[int]) -> tuple[int]:
+    """Intersect two regions of interest.
+
+    Args:
+        first (tuple[int]): region (x0, y0, x1, y1), or None for the whole image.
+        second (tuple[int]): region (x0, y0, x1, y1), or None for the whole image.
+
+    Returns:
+        tuple[int]: intersection (x0, y0, x1, y1), or None for the whole image.
+    """
+    if first is None:
+        return second
+    if second is None:
+        return first
+    return (
+        max(first[0], second[0]),
+        max(first[1], second[1]),
+        min(first[2], second[2]),
+        min(first[3], second[3]),
+    )
+
+
+class TemporalRoi:
+    """Region of interest following the markers from frame to frame.
+
+    The markers move only a few pixels between consecutive frames, so after a
+    frame with detections the search is narrowed to the bounding box of their
+    concave corners, enlarged by a margin which covers both the body of the
+    markers and their motion. A search over the whole base region is performed
+    every keyframeInterval frames, and whenever the previous frame had no
+    detections, so the markers entering the scene are eventually found.
+    """
+
+    def __init__(
+        self,
+        baseRoi: tuple[int] = mkdtct.MARKERS_ROI,
+        margin: int = 250,
+        keyframeInterval: int = 30,
+    ) -> None:
+        """Initialize the region of interest to the base one.
+
+        Args:
+            baseRoi (tuple[int], optional): region (x0, y0, x1, y1) searched on the
+            keyframes, and never exceeded. Defaults to MARKERS_ROI.
+            margin (int, optional): pixels added around the bounding box of the
+            previous detections. Defaults to 250.
+            keyframeInterval (int, optional): maximum number of frames between two
+            searches over the whole base region. Defaults to 30.
+        """
+        self.baseRoi = baseRoi
+        self.margin = margin
+        self.keyframeInterval = keyframeInterval
+        self._trackedRoi = None
+        self._framesSinceKeyframe = 0
+
+    def nextRoi(self) -> tuple[int]:
+        """Region of interest to be searched in the next frame.
+
+        Returns:
+            tuple[int]: region (x0, y0, x1, y1).
+        """
+        if (
+            self._trackedRoi is None
+            or self._framesSinceKeyframe + 1 >= self.keyframeInterval
+        ):
+            self._framesSinceKeyframe = 0
+            return self.baseRoi
+        self._framesSinceKeyframe += 1
+        return self._trackedRoi
+
+    def update(self, detections: list[MarkerDetection]) -> None:
+        """Narrow the region of interest around the latest detections.
+
+        Args:
+            detections (list[MarkerDetection]): markers detected in the last frame.
+        """
+        if not detections:
+            self._trackedRoi = None
+            return
+        corners = np.array([(detection.px, detection.py) for detection in detections])
+        x0, y0 = corners.min(axis=0) - self.margin
+        x1, y1 = corners.max(axis=0) + self.margin + 1
+        self._trackedRoi = intersectRois(
+            (int(x0), int(y0), int(x1), int(y1)), self.baseRoi
+        )
+
+    def detect(
+        self,
+        image: np.ndarray,
+        currentFrame: int,
+        annotate: bool = True,
+        profiler=NULL_PROFILER,
+    ) -> list[MarkerDetection]:
+        """Detect and label the markers of the frame within the tracked region of
+        interest, and update it.
+
+        Args:
+            image (np.ndarray): input image.
+            currentFrame (int): index of the current image.
+            annotate (bool, optional): whether to draw the markers on the image.
+            Defaults to True.
+            profiler (optional): stage_profiler.StageProfiler recording the time
+            spent in each stage. Defaults to NULL_PROFILER, which records nothing.
+
+        Returns:
+            list[MarkerDetection]: markers detected in the current frame.
+        """
+        detections = mkdtct.detectAndLabelMarkers(
+            image=image,
+            currentFrame=currentFrame,
+            roi=self.nextRoi(),
+            annotate=annotate,
+            profiler=profiler,
+        )
+        self.update(detections)
+        return detections
@@ -0,0 +1,196 @@
+import json
+from bisect import bisect_right
+from collections import Counter
+from time import perf_counter
+
+
+# Upper edges, in seconds, of the buckets of the timing histograms: they grow
+# by 25% from 1 microsecond to about 10 seconds, so any percentile is known
+# within 25% while the memory used doesn't depend on the number of frames.
+_BUCKET_EDGES = [1e-6 * 1.25**exponent for exponent in range(73)]
+
+
+class _TimingHistogram:
+    """Histogram of the durations of a stage."""
+
+    __slots__ = ("buckets", "samples", "total", "minimum", "maximum")
+
+    def __init__(self) -> None:
+        self.buckets = [0] * (len(_BUCKET_EDGES) + 1)
+        self.samples = 0
+        self.total = 0.0
+        self.minimum = float("inf")
+        self.maximum = 0.0
+
+    def add(self, duration: float) -> None:
+        self.buckets[bisect_right(_BUCKET_EDGES, duration)] += 1
+        self.samples += 1
+        self.total += duration
+        self.minimum = min(self.minimum, duration)
+        self.maximum = max(self.maximum, duration)
+
+    def merge(self, other: "_TimingHistogram") -> None:
+        for bucket, count in enumerate(other.buckets):
+            self.buckets[bucket] += count
+        self.samples += other.samples
+        self.total += other.total
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+
+    def percentile(self, fraction: float) -> float:
+        """Upper edge of the bucket holding the given fraction of the samples,
+        capped by the maximum duration.
+        """
+        threshold = fraction * self.samples
+        cumulated = 0
+        for bucket, count in enumerate(self.buckets):
+            cumulated += count
+            if cumulated >= threshold and count:
+                if bucket == len(_BUCKET_EDGES):
+                    return self.maximum
+                return min(_BUCKET_EDGES[bucket], self.maximum)
+        return self.maximum
+
+    def summary(self) -> dict:
+        # The durations are reported in milliseconds.
+        return {
+            "samples": self.samples,
+            "totalMs": self.total * 1000,
+            "meanMs": self.total / self.samples * 1000,
+            "minMs": self.minimum * 1000,
+            "p50Ms": self.percentile(0.5) * 1000,
+            "p90Ms": self.percentile(0.9) * 1000,
+            "p99Ms": self.percentile(0.99) * 1000,
+            "maxMs": self.maximum * 1000,
+            "histogram": [
+                {"upToMs": _BUCKET_EDGES[bucket] * 1000, "count": count}
+                for bucket, count in enumerate(self.buckets[:-1])
+                if count
+            ]
+            + (
+                [{"upToMs": None, "count": self.buckets[-1]}]
+                if self.buckets[-1]
+                else []
+            ),
+        }
+
+
+class StageProfiler:
+    """Per-stage instrumentation of the detection.
+
+    Every stage measures its wall time by chaining the timestamps returned by
+    now() and record(), and the amount of items it handled through count(). The
+    durations are aggregated in histograms and the counts in frequency tables as
+    they are recorded, so the profiler uses the same memory for any number of
+    frames. When profiling is disabled, NULL_PROFILER is used in its place: its
+    methods do nothing and never read the clock.
+
+    Stages running in different threads can share the same profiler, as long as
+    each stage name is recorded by a single thread.
+    """
+
+    def __init__(self) -> None:
+        self._timings = {}
+        self._counts = {}
+
+    def now(self) -> float:
+        """Current timestamp, to be passed to the next record().
+
+        Returns:
+            float: timestamp, in seconds.
+        """
+        return perf_counter()
+
+    def record(self, stage: str, start: float) -> float:
+        """Record the time elapsed since start as a run of the given stage.
+
+        Args:
+            stage (str): name of the stage.
+            start (float): timestamp returned by now() or by the previous record().
+
+        Returns:
+            float: current timestamp, which is the start of the next stage.
+        """
+        end = perf_counter()
+        histogram = self._timings.get(stage)
+        if histogram is None:
+            histogram = self._timings[stage] = _TimingHistogram()
+        histogram.add(end - start)
+        return end
+
+    def count(self, name: str, value: int) -> None:
+        """Record the amount of items handled by a stage in the current frame.
+
+        Args:
+            name (str): name of the counter.
+            value (int): amount of items.
+        """
+        counter = self._counts.get(name)
+        if counter is None:
+            counter = self._counts[name] = Counter()
+        counter[value] += 1
+
+    def merge(self, other: "StageProfiler") -> None:
+        """Add the records of another profiler, such as one of a worker process.
+
+        Args:
+            other (StageProfiler): profiler to merge into this one.
+        """
+        for stage, histogram in other._timings.items():
+            self._timings.setdefault(stage, _TimingHistogram()).merge(histogram)
+        for name, counter in other._counts.items():
+            self._counts.setdefault(name, Counter()).update(counter)
+
+    def summary(self) -> dict:
+        """Aggregate the records.
+
+        Returns:
+            dict: timing statistics and histogram of each stage, and statistics and
+            frequency table of each counter.
+        """
+        counts = {}
+        for name, counter in self._counts.items():
+            frames = sum(counter.values())
+            total = sum(value * frequency for value, frequency in counter.items())
+            counts[name] = {
+                "frames": frames,
+                "total": total,
+                "mean": total / frames,
+                "min": min(counter),
+                "max": max(counter),
+                "histogram": {
+                    str(value): counter[value] for value in sorted(counter)
+                },
+            }
+        return {
+            "stages": {
+                stage: histogram.summary()
+                for stage, histogram in self._timings.items()
+            },
+            "counts": counts,
+        }
+
+    def exportJson(self, path: str) -> None:
+        """Write the aggregated records to a json file.
+
+        Args:
+            path (str): path of the json file.
+        """
+        with open(path, "w") as jsonFile:
+            json.dump(self.summary(), jsonFile, indent=2)
+
+
+class _NullProfiler:
+    """Profiler doing nothing, used when profiling is disabled."""
+
+    def now(self) -> float:
+        return 0.0
+
+    def record(self, stage: str, start: float) -> float:
+        return 0.0
+
+    def count(self, name: str, value: int) -> None:
+        pass
+
+
+NULL_PROFILER = _NullProfiler()
@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+import marker_detector as mkdtct
+
+
+def _sampleAxisReference(gray, x0, y0, x1, y1):
+    """Label and sampled points of an axis, decoded as the original per-marker
+    loop did: sampling the Bresenham line of the axis every cycleJump pixels,
+    with the 0.9 and 0.85 perspective corrections. None if cycleJump is 0, where
+    the loop raised ValueError.
+    """
+    markerAxis = mkdtct.bresenhamLineGenerator(x0, y0, x1, y1)
+    cycleJump = int(len(markerAxis) / 10 * 1.95)
+    if cycleJump == 0:
+        return None
+    binaryRepr = ""
+    points = []
+    for actCycle, intervalCentreIndex in enumerate(
+        range(cycleJump, len(markerAxis), cycleJump)
+    ):
+        tempIndex = intervalCentreIndex
+        if actCycle in [1, 2, 3, 4]:
+            tempIndex = int(tempIndex * 0.85)
+        elif actCycle == 0:
+            tempIndex = int(tempIndex * 0.9)
+        point = markerAxis[tempIndex]
+        points.append(point)
+        binaryRepr += "0" if gray[point[1], point[0]] > 180 else "1"
+    return int(binaryRepr[::-1], 2), points
+
+
+def test_sampleMarkerAxes_matches_bresenham_loop():
+    rng = np.random.default_rng(0)
+    # The Bresenham lines can leave the box of their endpoints, so the axes lie
+    # in the middle of the image, far from its borders.
+    gray = rng.integers(0, 256, (1600, 1600), dtype=np.uint8)
+    axesCount = 20000
+    startPoints = rng.integers(600, 1000, (axesCount, 2))
+    # Short axes too, down to a single pixel, whose cycleJump is 0.
+    endPoints = np.where(
+        rng.random((axesCount, 1)) < 0.2,
+        startPoints + rng.integers(-5, 6, (axesCount, 2)),
+        rng.integers(600, 1000, (axesCount, 2)),
+    )
+
+    markerIds, samplePoints, validSamples = mkdtct.sampleMarkerAxes(
+        gray, startPoints, endPoints
+    )
+
+    shortAxes = 0
+    for index, ((x0, y0), (x1, y1)) in enumerate(zip(startPoints, endPoints)):
+        reference = _sampleAxisReference(gray, int(x0), int(y0), int(x1), int(y1))
+        if reference is None:
+            shortAxes += 1
+            assert not validSamples[index].any()
+            continue
+        referenceId, referencePoints = reference
+        assert markerIds[index] == referenceId
+        assert samplePoints[index][validSamples[index]].tolist() == [
+            list(point) for point in referencePoints
+        ]
+    assert shortAxes > 0
+
+
+def _pentagon(vertices):
+    return np.array(vertices, dtype=np.int32).reshape(5, 1, 2)
+
+
+# Marker outline: the concave corner is in (100, 100), the short sides are the
+# two meeting in it and the lower side.
+MARKER = [(100, 100), (65, 135), (65, 290), (135, 290), (135, 135)]
+
+
+def test_findConcaveCorners_finds_marker_corner():
+    corners, middlePoints = mkdtct.findConcaveCorners([_pentagon(MARKER)])[:2]
+    assert corners.tolist() == [[100, 100]]
+    assert middlePoints.tolist() == [[100, 290]]
+
+
+@pytest.mark.parametrize(
+    "vertices",
+    [
+        # Lower side longer than 80: only the sides of the concave corner are
+        # short.
+        [(100, 100), (65, 135), (50, 290), (150, 290), (135, 135)],
+        # A single short side, from (200, 200) to (150, 250).
+        [(0, 0), (200, 0), (200, 200), (150, 250), (0, 200)],
+        # The marker twice as large: no short side at all.
+        [(2 * x, 2 * y) for x, y in MARKER],
+    ],
+)
+def test_findConcaveCorners_skips_polygons_with_few_short_sides(vertices):
+    # Such pentagons used to raise IndexError in the per-polygon search.
+    assert mkdtct._findConcaveCornerInPolygon(_pentagon(vertices)) is None
+    corners, middlePoints = mkdtct.findConcaveCorners(
+        [_pentagon(MARKER), _pentagon(vertices)]
+    )[:2]
+    assert corners.tolist() == [[100, 100]]
+    assert middlePoints.tolist() == [[100, 290]]
+
+
+def test_coarse_to_fine_search_finds_the_markers():
+    import benchmark
+
+    frame, groundTruth = benchmark.renderTurntableFrame(0, noise=2.0)
+    detections = mkdtct.MarkerDetector(frame.shape, pyramidScale=0.5).detect(
+        frame, 0, annotate=False
+    )
+    accuracy = benchmark.checkAccuracy({0: detections}, [groundTruth], tolerance=2)
+    assert accuracy["recall"] == 1.0
+    assert accuracy["precision"] == 1.0
+    with pytest.raises(ValueError):
+        mkdtct.MarkerDetector(frame.shape, pyramidScale=1.5)